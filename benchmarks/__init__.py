@@ -0,0 +1 @@
+# This is a package for benchmarking the bot's stores
@@ -0,0 +1,222 @@
+"""Runs the store benchmarks
+
+Usage:
+
+    python -m benchmarks [--backend NAME]... [--keys N] [--ops N] [--seed N]
+                         [--output FILE] [--compare FILE]
+
+Each backend runs in its own process so that its peak RSS can be measured.
+Results are printed and written as JSON to the output file (if given) along
+with the current commit. Pass an older results file to --compare to see the
+change in throughput and p99 latency.
+
+The move backend runs each workload while moving a newly populated store.
+Its results say whether the move was still going when the workload ended.
+
+The postgresql backend only runs if ULHACKS_BENCHMARK_DATABASE_URL is set.
+Its "store" table is emptied before and after, so use a throwaway database.
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from .backends import BACKENDS
+from .workloads import WORKLOADS, populate
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    def percentile(fraction):
+        index = min(len(latencies) - 1, int(fraction * len(latencies)))
+        return latencies[index] / 1e6
+    return {
+        "ops": len(latencies),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+async def empty(store):
+    keys = [key async for key in store.keys()]
+    for i in range(0, len(keys), 1000):
+        await store.delete_many(keys[i:i+1000])
+    set_keys = [key async for key in store.set_keys()]
+    for key in set_keys:
+        members = await store.set_members(key)
+        if members:
+            await store.set_remove(key, *members)
+
+async def start_move(store):
+    """Starts moving the store and returns the task once it's moving"""
+    task = asyncio.create_task(store.move())
+    # Some stores never yield, so make sure the move has started before
+    # timing anything
+    while not store.moving and not task.done():
+        await asyncio.sleep(0)
+    return task
+
+async def run_backend(name, *, num_keys, ops, seed):
+    """Runs every workload against a new store and returns the results
+
+    Stores that can be moved run each workload during a new move.
+
+    """
+    rng = random.Random(seed)
+    result = {"backend": name, "workloads": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            store = BACKENDS[name](directory)
+        except LookupError as e:
+            return {"backend": name, "error": str(e)}
+        moves = hasattr(store, "move")
+        try:
+            await empty(store)
+            start = time.perf_counter()
+            await populate(store, rng, num_keys)
+            result["populate_seconds"] = time.perf_counter() - start
+            for i, (workload_name, workload) in enumerate(WORKLOADS.items()):
+                move_task = None
+                if moves:
+                    if i > 0:
+                        # The last move has finished so start over
+                        await store.close()
+                        subdirectory = os.path.join(directory, str(i))
+                        os.mkdir(subdirectory)
+                        store = BACKENDS[name](subdirectory)
+                        await populate(store, rng, num_keys)
+                    move_task = await start_move(store)
+                kwargs = {}
+                if workload_name == "help_lookup":
+                    kwargs["num_keys"] = num_keys
+                start = time.perf_counter()
+                latencies = await workload(store, rng, ops, **kwargs)
+                seconds = time.perf_counter() - start
+                result["workloads"][workload_name] = summarize(
+                    latencies,
+                    seconds,
+                )
+                if move_task is not None:
+                    # Whether the move lasted until the workload finished
+                    moving = store.moving
+                    result["workloads"][workload_name]["moving"] = moving
+                    await move_task
+            await empty(store)
+        finally:
+            await store.close()
+    # Linux reports this in kilobytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_kb"] = peak
+    return result
+
+def run_child(name, args):
+    # Run the backend in a new process and return its results
+    process = subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks", "--child", name,
+            "--keys", str(args.keys),
+            "--ops", str(args.ops),
+            "--seed", str(args.seed),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    if process.returncode != 0:
+        return {"backend": name, "error": f"exited with {process.returncode}"}
+    return json.loads(process.stdout)
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    header = (
+        f"{'backend':<11} {'workload':<12} {'ops/sec':>10}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    if baseline is not None:
+        header += f" {'ops/sec Δ':>10} {'p99 Δ':>8}"
+    print(header)
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<11} error: {result['error']}")
+            continue
+        old = {}
+        if baseline is not None:
+            old = baseline.get(name, {}).get("workloads", {})
+        for workload, stats in result["workloads"].items():
+            line = (
+                f"{name:<11} {workload:<12} {stats['throughput']:>10.1f}"
+                f" {stats['p50_ms']:>8.3f} {stats['p95_ms']:>8.3f}"
+                f" {stats['p99_ms']:>8.3f}"
+            )
+            if workload in old and old[workload]["throughput"]:
+                throughput = stats["throughput"] / old[workload]["throughput"]
+                p99 = stats["p99_ms"] / old[workload]["p99_ms"]
+                line += f" {throughput:>9.2f}x {p99:>7.2f}x"
+            print(line)
+        print(f"{name:<11} peak RSS: {result['peak_rss_kb'] / 1024:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "--backend",
+        action="append",
+        choices=list(BACKENDS),
+        help="backend to run (can be repeated, defaults to all)",
+    )
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write JSON results to")
+    parser.add_argument("--compare", help="JSON results file to compare to")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        result = asyncio.run(run_backend(
+            args.child,
+            num_keys=args.keys,
+            ops=args.ops,
+            seed=args.seed,
+        ))
+        json.dump(result, sys.stdout)
+        return
+
+    results = {}
+    for name in args.backend or list(BACKENDS):
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = run_child(name, args)
+    output = {
+        "commit": current_commit(),
+        "python": sys.version,
+        "params": {"keys": args.keys, "ops": args.ops, "seed": args.seed},
+        "results": results,
+    }
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, mode="w") as file:
+            json.dump(output, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Functions making each store backend for benchmarking
+
+Each function takes a directory for files and returns a new store.
+
+"""
+import os
+
+def make_json(directory):
+    import store.json
+    return store.json.JsonStore(os.path.join(directory, "store.json"))
+
+def make_resident(directory):
+    import store.json
+    filename = os.path.join(directory, "store.json")
+    return store.json.ResidentJsonStore(filename)
+
+def make_sharded(directory):
+    import store.sharded
+    directory = os.path.join(directory, "shards")
+    return store.sharded.ShardedJsonStore(directory)
+
+def make_log(directory):
+    import store.log
+    return store.log.LogStore(os.path.join(directory, "store"))
+
+def make_snapshot(directory):
+    import store.snapshot
+    filename = os.path.join(directory, "store")
+    return store.snapshot.SnapshotStore(filename)
+
+def make_sqlite(directory):
+    import store.sqlite
+    return store.sqlite.SqliteStore(os.path.join(directory, "store.db"))
+
+def make_postgresql(directory):
+    # Needs an explicit address since the benchmark empties the table
+    import store.postgresql
+    address = os.environ.get("ULHACKS_BENCHMARK_DATABASE_URL", "")
+    if not address:
+        raise LookupError("ULHACKS_BENCHMARK_DATABASE_URL isn't set")
+    return store.postgresql.PostgresqlStore(address)
+
+def make_move(directory):
+    # The benchmark starts the move after populating the first store
+    import store.move
+    return store.move.MoveStore(
+        make_resident(directory),
+        make_sqlite(directory),
+    )
+
+BACKENDS = {
+    "json": make_json,
+    "resident": make_resident,
+    "sharded": make_sharded,
+    "log": make_log,
+    "snapshot": make_snapshot,
+    "sqlite": make_sqlite,
+    "postgresql": make_postgresql,
+    "move": make_move,
+}
@@ -0,0 +1,111 @@
+"""Compares PostgresqlStore against connecting once per operation
+
+Run this with a local PostgreSQL server:
+
+    python -m benchmarks.postgresql_pool [address]
+
+The address defaults to PostgresqlStore.DEFAULT_ADDRESS. Note that this uses
+the same "store" table as the bot, so don't point it at a production database.
+
+This only compares pooling against connecting per operation. It hasn't been
+run against a real database yet, and it doesn't compare pool sizes, so the
+store's default pool sizes aren't based on it.
+
+"""
+import asyncio
+import sys
+import time
+
+import asyncpg
+
+from store.postgresql import PostgresqlStore
+
+class ConnectPerOpStore:
+    """How PostgresqlStore used to work: one connection per operation"""
+    def __init__(self, address):
+        self.address = address
+
+    async def set(self, key, value):
+        conn = await asyncpg.connect(self.address)
+        try:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS store (
+                        key TEXT NOT NULL PRIMARY KEY,
+                        value TEXT NOT NULL
+                    );
+                ''')
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO store (key, value)
+                    VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE
+                    SET value = $2;
+                ''', key, value)
+        finally:
+            await conn.close()
+
+    async def get(self, key):
+        conn = await asyncpg.connect(self.address)
+        try:
+            value = await conn.fetchval('''
+                SELECT value FROM store
+                WHERE key = $1 LIMIT 1;
+            ''', key)
+            return value or ""
+        finally:
+            await conn.close()
+
+    async def close(self):
+        pass
+
+async def run_ops(store, *, ops, concurrency):
+    """Runs a mix of 3 gets per set (like Moderators.update_member)"""
+    async def worker(worker_id):
+        for i in range(worker_id, ops, concurrency):
+            key = f"benchmark/{i % 100}"
+            if i % 4 == 0:
+                await store.set(key, str(i))
+            else:
+                await store.get(key)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return ops / (time.perf_counter() - start)
+
+async def main_async(address, *, ops=2000, concurrency=8):
+    results = {}
+    for name, store in [
+        ("connect per op", ConnectPerOpStore(address)),
+        ("pooled", PostgresqlStore(address, max_size=concurrency)),
+    ]:
+        try:
+            # Warm up (creates the table and pool)
+            await store.set("benchmark/warmup", "1")
+            results[name] = await run_ops(
+                store,
+                ops=ops,
+                concurrency=concurrency,
+            )
+        finally:
+            await store.close()
+        print(f"{name}: {results[name]:.1f} ops/sec")
+    # Remove the keys made by the benchmark
+    store = PostgresqlStore(address)
+    try:
+        await store.delete_many(
+            ["benchmark/warmup", *(f"benchmark/{i}" for i in range(100))]
+        )
+    finally:
+        await store.close()
+    speedup = results["pooled"] / results["connect per op"]
+    print(f"speedup: {speedup:.1f}x")
+    return results
+
+def main():
+    address = sys.argv[1] if len(sys.argv) > 1 else None
+    if address is None:
+        address = PostgresqlStore.DEFAULT_ADDRESS
+    asyncio.run(main_async(address))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Synthetic workloads shaped like the cogs' use of the store
+
+Each workload takes a store, a random.Random and a number of operations, and
+returns a list of latencies in nanoseconds (one per operation).
+
+"""
+import time
+
+NUM_GUILDS = 4
+NUM_MODERATORS = 50
+
+async def populate(store, rng, num_keys):
+    """Fills the store with keys like the cogs' (mostly registrations)"""
+    items = []
+    for guild in range(NUM_GUILDS):
+        key = f"moderators/{guild}"
+        items += [
+            (f"{key}/roles", "Moderator Organizer"),
+            (f"{key}/prefix", "Available:"),
+            (f"help/category/{guild}", "Help Channels"),
+        ]
+    for i in range(num_keys - len(items)):
+        if i % 4 == 0:
+            items.append((f"help/owner/{i}", str(rng.randrange(10**18))))
+        else:
+            items.append((f"message/register/{i}", "1"))
+    for i in range(0, len(items), 1000):
+        await store.set_many(items[i:i+1000])
+    for guild in range(NUM_GUILDS):
+        online = rng.sample(range(NUM_MODERATORS), NUM_MODERATORS // 2)
+        await store.set_add(f"moderators/{guild}/onlineids", *online)
+    return num_keys
+
+async def presence(store, rng, ops):
+    """Moderators.update_member: add to or remove from the onlineids set"""
+    latencies = []
+    for _ in range(ops):
+        guild = rng.randrange(NUM_GUILDS)
+        member = rng.randrange(NUM_MODERATORS)
+        key = f"moderators/{guild}/onlineids"
+        start = time.perf_counter_ns()
+        if rng.random() < 0.5:
+            await store.set_add(key, member)
+        else:
+            await store.set_remove(key, member)
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+async def register(store, rng, ops):
+    """Message.register: check then set message/register/<id>"""
+    latencies = []
+    for _ in range(ops):
+        user = rng.randrange(10**18)
+        start = time.perf_counter_ns()
+        if not await store.get(f"message/register/{user}"):
+            await store.set(f"message/register/{user}", "1")
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+async def help_lookup(store, rng, ops, *, num_keys):
+    """Help.get_channel_owner: point reads of help/owner/<channel>"""
+    latencies = []
+    for _ in range(ops):
+        channel = rng.randrange(num_keys)
+        start = time.perf_counter_ns()
+        await store.get(f"help/owner/{channel}")
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+async def scan(store, rng, ops):
+    """Exec.copy and $keys: full scans of store.keys()"""
+    latencies = []
+    # Full scans are slow so do fewer of them
+    for _ in range(max(1, ops // 100)):
+        start = time.perf_counter_ns()
+        async for key in store.keys():
+            pass
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+WORKLOADS = {
+    "presence": presence,
+    "register": register,
+    "help_lookup": help_lookup,
+    "scan": scan,
+}
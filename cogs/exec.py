@@ -33,38 +33,91 @@ class Exec(commands.Cog):
         module = importlib.import_module(name)
         return importlib.reload(module)
 
-    async def move(self, new_store):
-        """Helper function to move the current store's data into a new store"""
+    async def move(self, new_store, ctx=None, *, interval=10):
+        """Helper function to move the current store's data into a new store
+
+        If ctx is given, progress is sent to its channel every interval
+        seconds.
+
+        """
         import store.move
+        from extensions.store import unwrap_store, wrap_store
+        # Move the data under the cache and stats, then put them back on top
         old_store = self.bot.store
+        move_store = store.move.MoveStore(unwrap_store(old_store), new_store)
+        reporter = None
+        if ctx is not None:
+            reporter = asyncio.create_task(
+                self.report_move(ctx, move_store, interval)
+            )
         try:
-            self.bot.store = store.move.MoveStore(old_store, new_store)
+            # A cache isn't needed for the move (and would have to be closed
+            # without closing the stores if the move failed)
+            self.bot.store = wrap_store(self.bot, move_store, cache=False)
             await asyncio.sleep(1)
-            await self.bot.store.move()
+            moved = await move_store.move()
             await asyncio.sleep(1)
-        except Exception:
+        except Exception as e:
             self.bot.store = old_store
+            if ctx is not None:
+                await ctx.send(f"Move failed: `{e!r}`")
         else:
-            self.bot.store = new_store
+            self.bot.store = wrap_store(self.bot, new_store)
+            # Closes the old cache and stats too
+            await old_store.close()
+            if ctx is not None:
+                if moved:
+                    await ctx.send(f"Moved {move_store.total} keys")
+                else:
+                    await ctx.send(
+                        "The new store already has the moved data, switched"
+                        " to it without copying"
+                    )
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+    @staticmethod
+    async def report_move(ctx, move_store, interval):
+        """Helper function to periodically send a move's progress"""
+        import time
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            copied, total = move_store.copied, move_store.total
+            rate = copied / (time.monotonic() - start)
+            if rate > 0:
+                eta = f"{(total - copied) / rate:.0f}s"
+            else:
+                eta = "unknown"
+            await ctx.send(
+                f"Moved {copied}/{total} keys"
+                f" ({rate:.1f} keys/sec, ETA {eta})"
+            )
 
-    async def copy(self, new_store):
+    async def copy(self, new_store, *, batch_size=100):
         """Helper function to copy the current store's data into a new store"""
-        async for key in self.bot.store.keys():
-            value = await self.bot.store.get(key)
-            await new_store.set(key, value)
+        import store
+        async for keys in store.batched(self.bot.store.keys(), batch_size):
+            values = await self.bot.store.get_many(keys)
+            await new_store.set_many(zip(keys, values))
+        async for key in self.bot.store.set_keys():
+            members = await self.bot.store.set_members(key)
+            await new_store.set_add(key, *members)
 
     async def backup(self, ctx):
-        """Helper function to send a JSON file with the current store's data"""
+        """Helper function to send a file with the current store's data
+
+        The file is gzipped NDJSON that can be loaded with store.dump.load.
+
+        """
         import os
-        import random
-        import store.json
-        filename = f"temp-json-store-{random.randint(1, 9999):0>4}.json"
-        try:
-            json_store = store.json.JsonStore(filename)
-            await self.copy(json_store)
+        import tempfile
+        import store.dump
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "store-backup.ndjson.gz")
+            await store.dump.dump(self.bot.store, filename)
             await ctx.send(file=discord.File(filename))
-        finally:
-            await asyncio.to_thread(os.unlink, filename)
 
     @staticmethod
     def clean_code(text):
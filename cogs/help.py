@@ -1,5 +1,7 @@
 """Handles help categories and channels"""
 
+import asyncio
+import traceback
 import discord
 from discord.ext import commands
 
@@ -21,9 +23,151 @@ async def is_help_channel_owner_check(ctx):
     else:
         raise commands.CheckFailure("You aren't the help channel creator")
 
+def with_read_access(overwrites, *targets):
+    """Returns the overwrites with the targets allowed to read messages"""
+    overwrites = dict(overwrites)
+    for target in targets:
+        overwrite = overwrites.get(target) or discord.PermissionOverwrite()
+        overwrite.update(read_messages=True)
+        overwrites[target] = overwrite
+    return overwrites
+
+class CategoryIndex:
+    """A guild's categories and the channels in each of them"""
+
+    # Maximum number of channels Discord allows in a category
+    LIMIT = 50
+
+    def __init__(self, guild):
+        # Uppercased category names mapped to the IDs of those categories
+        self.names = {}
+        # Category IDs mapped to the IDs of their channels
+        self.channels = {}
+        for channel in guild.channels:
+            self.add(channel)
+
+    def add(self, channel):
+        if isinstance(channel, discord.CategoryChannel):
+            self.names.setdefault(channel.name.upper(), set()).add(channel.id)
+            self.channels.setdefault(channel.id, set())
+        elif channel.category_id is not None:
+            channel_ids = self.channels.setdefault(channel.category_id, set())
+            channel_ids.add(channel.id)
+
+    def remove(self, channel):
+        if isinstance(channel, discord.CategoryChannel):
+            self._remove_name(channel)
+            self.channels.pop(channel.id, None)
+        elif channel.category_id is not None:
+            channel_ids = self.channels.get(channel.category_id, set())
+            channel_ids.discard(channel.id)
+
+    def update(self, before, after):
+        if isinstance(after, discord.CategoryChannel):
+            # Keep the category's channels when it's renamed
+            self._remove_name(before)
+            self.names.setdefault(after.name.upper(), set()).add(after.id)
+        else:
+            self.remove(before)
+            self.add(after)
+
+    def refresh(self, category):
+        """Recounts the category's channels from the guild's cache"""
+        self.channels[category.id] = {
+            channel.id for channel in category.channels
+        }
+
+    def _remove_name(self, category):
+        category_ids = self.names.get(category.name.upper(), set())
+        category_ids.discard(category.id)
+        if not category_ids:
+            self.names.pop(category.name.upper(), None)
+
+    def find(self, name):
+        """Returns the ID of a category with the name and room for a channel
+
+        Returns None if there are no categories with the name. Raises
+        LookupError if they are all full.
+
+        """
+        category_ids = self.names.get(name.upper())
+        if not category_ids:
+            return None
+        for category_id in sorted(category_ids):
+            if len(self.channels.get(category_id, ())) < self.LIMIT:
+                return category_id
+        raise LookupError(f"all categories named {name} are full")
+
+class OwnerIndex:
+    """A guild's help channels and their creators"""
+
+    def __init__(self):
+        # Help channel IDs mapped to their creator's user ID
+        self.owners = {}
+        # User IDs mapped to the IDs of the help channels they created
+        self.channels = {}
+
+    def add(self, channel_id, owner_id):
+        self.remove(channel_id)
+        self.owners[channel_id] = owner_id
+        self.channels.setdefault(owner_id, set()).add(channel_id)
+
+    def remove(self, channel_id):
+        owner_id = self.owners.pop(channel_id, None)
+        if owner_id is None:
+            return
+        channel_ids = self.channels[owner_id]
+        channel_ids.discard(channel_id)
+        if not channel_ids:
+            del self.channels[owner_id]
+
+def get_lock(locks, key):
+    """Returns the lock for the key, making it if needed"""
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
 class Help(commands.Cog):
+    # Pool channels created per minute while refilling by default
+    DEFAULT_POOL_RATE = 5
+    # Longest wait before retrying after failing to create a pool channel
+    MAX_REFILL_BACKOFF = 600
+    # Longest wait before restarting a failed watch of the pool settings
+    MAX_WATCH_RETRY_DELAY = 60
+    # Longest wait for the cache to see a change to a channel's overwrites
+    OVERWRITES_UPDATE_TIMEOUT = 5
+
     def __init__(self, bot):
         self.bot = bot
+        # Guild IDs mapped to their category index
+        self._indexes = {}
+        # Guild IDs mapped to the task loading their owner index
+        self._owner_indexes = {}
+        # Guild IDs mapped to the lock held while placing a new help channel
+        self._locks = {}
+        # Guild IDs mapped to the lock held while claiming a pool channel
+        self._claim_locks = {}
+        # Channel IDs mapped to the lock held while changing its overwrites
+        self._overwrites_locks = {}
+        # Guild IDs mapped to the task refilling their pool
+        self._refills = {}
+        # Guild IDs mapped to their pool size and refill rate. They're only
+        # cached while the store's changes to them are being watched.
+        self._pool_settings = {}
+        self._pool_watch = None
+        self._pool_watching = None
+        # The store being watched (bot.store is replaced by moves and reloads)
+        self._pool_watched_store = None
+        # Changed whenever pool settings change, so reads in flight then
+        # aren't cached
+        self._pool_version = 0
+
+    def cog_unload(self):
+        for task in self._refills.values():
+            task.cancel()
+        if self._pool_watch is not None:
+            self._pool_watch.cancel()
 
     @commands.command()
     @commands.check_any(
@@ -41,6 +185,42 @@ class Help(commands.Cog):
             await self.set_category_name(ctx.guild, name)
             await ctx.send(f"Updated this server's help category name")
 
+    @commands.command(ignore_extra=False)
+    @commands.check_any(
+        commands.has_permissions(manage_guild=True),
+        commands.has_role("Organizer"),
+    )
+    async def helppool(self, ctx, size: int = None, rate: float = None):
+        """Gets or sets the number of hidden help channels kept ready
+
+        The rate is the most channels created per minute while refilling.
+        New help channels are taken from the pool when it isn't empty.
+
+        """
+        if size is None:
+            size, rate = await self.get_pool_settings(ctx.guild)
+            await ctx.send(
+                f"This server's help channel pool size is {size}, refilled"
+                f" at up to {rate} channels per minute"
+            )
+            return
+        if size < 0 or (rate is not None and rate <= 0):
+            await ctx.send(
+                "The size can't be negative and the rate must be positive"
+            )
+            return
+        items = [(f"help/poolsize/{ctx.guild.id}", str(size))]
+        if rate is not None:
+            items.append((f"help/poolrate/{ctx.guild.id}", str(rate)))
+        else:
+            _, rate = await self.get_pool_settings(ctx.guild)
+        await self.bot.store.set_many(items)
+        self._pool_version += 1
+        self._pool_settings.pop(ctx.guild.id, None)
+        # Also drains the pool if it's now smaller
+        await self.schedule_refill(ctx.guild, force=True)
+        await ctx.send(f"Updated this server's help channel pool")
+
     @commands.command(ignore_extra=False)
     @commands.check_any(
         commands.has_permissions(manage_guild=True),
@@ -64,9 +244,25 @@ class Help(commands.Cog):
     @commands.check(is_help_channel_check)
     async def add(self, ctx, *users: discord.Member):
         """Adds members into the current help channel"""
-        # Add overrides for users specified
-        for user in users:
-            await ctx.channel.set_permissions(user, read_messages=True)
+        channel = ctx.channel
+        if len(users) == 1:
+            # Only changes this user's overwrite
+            overwrite = channel.overwrites_for(users[0])
+            overwrite.update(read_messages=True)
+            await self.edit_overwrites(
+                channel,
+                lambda: channel.set_permissions(users[0], overwrite=overwrite),
+            )
+        else:
+            # Add overrides for users specified in one request. The
+            # overwrites are merged once the lock is held so changes made
+            # just before aren't undone.
+            await self.edit_overwrites(
+                channel,
+                lambda: channel.edit(
+                    overwrites=with_read_access(channel.overwrites, *users),
+                ),
+            )
         # Mention the added users
         mentions = [user.mention for user in users]
         await ctx.channel.send(f"Added {', '.join(mentions)}")
@@ -81,10 +277,64 @@ class Help(commands.Cog):
 
         """
         # Remove override for the user
-        await ctx.channel.set_permissions(ctx.author, overwrite=None)
+        await self.edit_overwrites(
+            ctx.channel,
+            lambda: ctx.channel.set_permissions(ctx.author, overwrite=None),
+        )
         # Mention the user that left
         await ctx.send(f"{ctx.author.mention} left :(")
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Channels could have been left in pools turned off while offline
+        await asyncio.gather(*(
+            self.schedule_refill(guild, force=True)
+            for guild in self.bot.guilds
+        ))
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        index = self._indexes.get(channel.guild.id)
+        if index is not None:
+            index.add(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self._overwrites_locks.pop(channel.id, None)
+        index = self._indexes.get(channel.guild.id)
+        if index is not None:
+            index.remove(channel)
+        task = self._owner_indexes.get(channel.guild.id)
+        if task is None:
+            pass
+        elif (
+            task.done()
+            and not task.cancelled()
+            and task.exception() is None
+        ):
+            task.result().remove(channel.id)
+        else:
+            # The load may have read the channel's owner already
+            del self._owner_indexes[channel.guild.id]
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        index = self._indexes.get(after.guild.id)
+        if index is not None:
+            index.update(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._indexes.pop(guild.id, None)
+        self._owner_indexes.pop(guild.id, None)
+
+    def get_category_index(self, guild):
+        """Returns the guild's category index, building it if needed"""
+        index = self._indexes.get(guild.id)
+        if index is None:
+            index = self._indexes[guild.id] = CategoryIndex(guild)
+        return index
+
     async def get_category_name(self, guild):
         """Return the help category name for the guild
 
@@ -100,16 +350,55 @@ class Help(commands.Cog):
         """Sets the help category name for the guild"""
         await self.bot.store.set(f"help/category/{guild.id}", name)
 
+    async def get_owner_index(self, guild):
+        """Returns the guild's owner index, loading it if needed
+
+        Loading reads the owners of all the guild's text channels at once.
+        Concurrent calls (like a command's checks) share the same load.
+
+        """
+        task = self._owner_indexes.get(guild.id)
+        if task is None:
+            task = asyncio.create_task(self._load_owner_index(guild))
+            self._owner_indexes[guild.id] = task
+        try:
+            # Don't cancel the load if the caller is cancelled
+            return await asyncio.shield(task)
+        except Exception:
+            # Try again next time
+            if self._owner_indexes.get(guild.id) is task:
+                del self._owner_indexes[guild.id]
+            raise
+
+    async def _load_owner_index(self, guild):
+        channel_ids = [channel.id for channel in guild.text_channels]
+        owner_ids = await self.bot.store.get_many(
+            f"help/owner/{channel_id}" for channel_id in channel_ids
+        )
+        index = OwnerIndex()
+        for channel_id, owner_id in zip(channel_ids, owner_ids):
+            if owner_id:
+                index.add(channel_id, int(owner_id))
+        return index
+
     async def get_channel_owner(self, channel):
         """Returns the user ID of the creator of this help channel
 
         If not found, a LookupError will be raised.
 
         """
-        owner_id = await self.bot.store.get(f"help/owner/{channel.id}")
-        if not owner_id:
-            raise LookupError(f"could not get owner of {channel.id}")
-        return int(owner_id)
+        guild = getattr(channel, "guild", None)
+        if guild is not None:
+            index = await self.get_owner_index(guild)
+            owner_id = index.owners.get(channel.id)
+            if owner_id is not None:
+                return owner_id
+        raise LookupError(f"could not get owner of {channel.id}")
+
+    async def get_owned_channels(self, guild, user):
+        """Returns the IDs of the help channels the user created"""
+        index = await self.get_owner_index(guild)
+        return set(index.channels.get(user.id, ()))
 
     async def is_help_channel(self, channel):
         try:
@@ -119,37 +408,272 @@ class Help(commands.Cog):
         else:
             return True
 
+    async def get_pool_settings(self, guild):
+        """Returns the guild's pool size and refill rate (per minute)
+
+        They're cached until the store's watch sees them change.
+
+        """
+        cacheable = self._ensure_watching_pool()
+        settings = self._pool_settings.get(guild.id)
+        if settings is not None:
+            return settings
+        version = self._pool_version
+        size, rate = await self.bot.store.get_many([
+            f"help/poolsize/{guild.id}",
+            f"help/poolrate/{guild.id}",
+        ])
+        rate = float(rate or self.DEFAULT_POOL_RATE)
+        settings = (int(size or "0"), rate)
+        # The settings could have changed during the read
+        if cacheable and version == self._pool_version:
+            self._pool_settings[guild.id] = settings
+        return settings
+
+    def _ensure_watching_pool(self):
+        # Returns whether pool settings read from now on can be cached
+        if (
+            self._pool_watch is not None
+            and self._pool_watched_store is not self.bot.store
+        ):
+            # The old store's watch won't see changes to the new one
+            self._pool_watch.cancel()
+            self._pool_watch = None
+            self._pool_version += 1
+            self._pool_settings.clear()
+        if self._pool_watch is None:
+            self._pool_watched_store = self.bot.store
+            self._pool_watching = asyncio.Event()
+            self._pool_watch = asyncio.create_task(self._watch_pool())
+        return self._pool_watching.is_set()
+
+    async def _watch_pool(self):
+        retry_delay = 0
+        while True:
+            try:
+                async for key in self._pool_watched_store.watch(
+                    "help/pool",
+                    ready=self._pool_watching,
+                ):
+                    retry_delay = 0
+                    # Skip changes to the pools themselves
+                    name, _, guild_id = key.rpartition("/")
+                    if name not in ("help/poolsize", "help/poolrate"):
+                        continue
+                    self._pool_version += 1
+                    self._pool_settings.pop(int(guild_id), None)
+                    # Start refilling (or draining) the pool
+                    guild = self.bot.get_guild(int(guild_id))
+                    if guild is not None:
+                        await self.schedule_refill(guild, force=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            # Changes could be missed until the watch is restarted
+            self._pool_watching.clear()
+            self._pool_version += 1
+            self._pool_settings.clear()
+            retry_delay = min(
+                self.MAX_WATCH_RETRY_DELAY,
+                max(1, retry_delay * 2),
+            )
+            await asyncio.sleep(retry_delay)
+
     async def make_help_channel(self, guild, creator):
         """Makes and returns a new help channel
 
-        This raises RuntimeError if the maximum number of channels in a server
+        A channel from the guild's pool is used if there is one. Otherwise,
+        this raises RuntimeError if the maximum number of channels in a server
         has been reached (for some reason).
 
         """
-        # Increment channel count and get next channel name
-        channel_count = int(
-            await self.bot.store.get(f"help/channels/{guild.id}")
-            or "0"
-        )
-        await self.bot.store.set(
-            f"help/channels/{guild.id}",
-            channel_count + 1,
+        size, _ = await self.get_pool_settings(guild)
+        channel = None
+        # Don't look in the store for a pool if it's disabled
+        if size > 0:
+            channel = await self.claim_pool_channel(guild, creator)
+        if channel is None:
+            channel = await self.create_help_channel(guild, creator)
+        await self.schedule_refill(guild)
+        return channel
+
+    async def claim_pool_channel(self, guild, creator):
+        """Gives the creator a hidden channel from the guild's pool
+
+        Returns None if the pool is empty.
+
+        """
+        key = f"help/pool/{guild.id}"
+        async with get_lock(self._claim_locks, guild.id):
+            for channel_id in sorted(
+                await self.bot.store.set_members(key),
+                key=int,
+            ):
+                await self.bot.store.set_remove(key, channel_id)
+                # Skip channels deleted while in the pool
+                channel = guild.get_channel(int(channel_id))
+                if channel is not None:
+                    break
+            else:
+                return None
+        await self.set_channel_owner(channel, creator)
+        # Reveal the channel to its creator
+        await self.edit_overwrites(
+            channel,
+            lambda: channel.set_permissions(creator, read_messages=True),
         )
-        channel_name = f"help-{channel_count + 1}"
+        return channel
+
+    async def edit_overwrites(self, channel, edit):
+        """Awaits edit() (which changes the channel's overwrites) with the
+        channel's lock held
+
+        The lock is held until the cache sees the change (or a few seconds
+        pass), so the next edit starts from the channel's current overwrites
+        instead of overwriting this change.
+
+        """
+        async with get_lock(self._overwrites_locks, channel.id):
+            # Start waiting first so the update can't be missed
+            updated = asyncio.ensure_future(self.bot.wait_for(
+                "guild_channel_update",
+                check=lambda before, after: after.id == channel.id,
+                timeout=self.OVERWRITES_UPDATE_TIMEOUT,
+            ))
+            try:
+                await edit()
+            except BaseException:
+                updated.cancel()
+                raise
+            try:
+                await updated
+            except asyncio.TimeoutError:
+                pass
+
+    async def create_help_channel(self, guild, creator=None):
+        """Creates and returns a new help channel
+
+        If creator is None, the channel is hidden and has no owner (like the
+        channels in a guild's pool).
+
+        """
+        # Increment channel count and get next channel name. This is atomic
+        # so concurrent calls get different numbers.
+        channel_number = await self.bot.store.incr(f"help/channels/{guild.id}")
+        channel_name = f"help-{channel_number}"
         # Get root category name
         root_category_name = await self.get_category_name(guild)
+        # Only place one channel at a time so the counts stay right
+        async with get_lock(self._locks, guild.id):
+            channel = await self._place_help_channel(
+                guild,
+                root_category_name,
+                channel_name,
+                creator,
+            )
+        # Set the owner id and return the channel
+        if creator is not None:
+            await self.set_channel_owner(channel, creator)
+        return channel
+
+    async def set_channel_owner(self, channel, creator):
+        """Sets the creator of this help channel"""
+        await self.bot.store.set(f"help/owner/{channel.id}", creator.id)
+        # A load that started earlier wouldn't have seen the new owner
+        index = await self.get_owner_index(channel.guild)
+        index.add(channel.id, creator.id)
+
+    async def schedule_refill(self, guild, *, force=False):
+        """Starts refilling the guild's pool if it isn't already
+
+        Nothing is done when the pool size is 0 unless force is True, which
+        also deletes channels left in the pool.
+
+        """
+        try:
+            size, _ = await self.get_pool_settings(guild)
+        except Exception:
+            # Let the refill task report the error and retry
+            size = None
+        if size == 0 and not force:
+            return
+        task = self._refills.get(guild.id)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refill(guild))
+            self._refills[guild.id] = task
+
+    async def _refill(self, guild):
+        key = f"help/pool/{guild.id}"
+        backoff = 0
+        while True:
+            try:
+                size, rate = await self.get_pool_settings(guild)
+                # Hold the claim lock so extra channels can't be claimed
+                # while they're being deleted
+                async with get_lock(self._claim_locks, guild.id):
+                    pool = await self.bot.store.set_members(key)
+                    # Forget channels deleted while in the pool
+                    deleted = [
+                        channel_id
+                        for channel_id in pool
+                        if guild.get_channel(int(channel_id)) is None
+                    ]
+                    if deleted:
+                        await self.bot.store.set_remove(key, *deleted)
+                    # Delete channels above the size (newest first)
+                    channel_ids = sorted(set(pool) - set(deleted), key=int)
+                    for channel_id in reversed(channel_ids[size:]):
+                        channel = guild.get_channel(int(channel_id))
+                        if channel is not None:
+                            await channel.delete()
+                        await self.bot.store.set_remove(key, channel_id)
+                if len(channel_ids) >= size:
+                    return
+                channel = await self.create_help_channel(guild)
+                try:
+                    await self.bot.store.set_add(key, channel.id)
+                except BaseException:
+                    # Don't leave a hidden channel that can't be claimed
+                    await channel.delete()
+                    raise
+            except discord.Forbidden:
+                # Retrying won't help until the bot gets the permissions
+                traceback.print_exc()
+                return
+            except Exception:
+                # Back off (like when rate limited) before trying again
+                traceback.print_exc()
+                backoff = min(self.MAX_REFILL_BACKOFF, max(1, backoff * 2))
+                await asyncio.sleep(backoff)
+                continue
+            backoff = 0
+            # Spread creations out so $new and others aren't rate limited
+            await asyncio.sleep(60 / rate)
+
+    async def _place_help_channel(
+        self,
+        guild,
+        root_category_name,
+        channel_name,
+        creator,
+    ):
+        index = self.get_category_index(guild)
         # Loop up category names from "name", "name 2", "name 3" upwards
         for suffix in range(1, 100):
             if suffix == 1:
                 category_name = root_category_name
             else:
                 category_name = f"{root_category_name} {suffix}"
-            # Check if a category with that name exists
-            for category in guild.categories:
-                # Do a case insensitive check (Discord UI always shows uppercase)
-                if category.name.upper() == category_name.upper():
-                    break
-            # If it doesn't, make one with that name
+            # Check if a category with that name and room exists (the index
+            # is case insensitive as the Discord UI always shows uppercase)
+            try:
+                category_id = index.find(category_name)
+            except LookupError:
+                continue
+            if category_id is not None:
+                category = guild.get_channel(category_id)
+            # If none exist, make one with that name
             else:
                 category = await guild.create_category(
                     category_name,
@@ -164,20 +688,23 @@ class Help(commands.Cog):
                         ),
                     },
                 )
-            # Try creating a channel in the category
+                index.add(category)
+            # Try creating a channel in the category that the creator can
+            # view. Channels created with overwrites don't sync with their
+            # category so the category's overwrites are included.
+            readers = [creator] if creator is not None else []
+            overwrites = with_read_access(category.overwrites, *readers)
             try:
-                channel = await category.create_text_channel(channel_name)
-            # We've reached the max number of channels in a category - continue
+                channel = await category.create_text_channel(
+                    channel_name,
+                    overwrites=overwrites,
+                )
+            # The index was wrong (it shouldn't be) - recount and continue
             except discord.HTTPException:
+                index.refresh(category)
                 continue
-            # Set the owner id, make them able to view the channel, and return
-            # the channel
             else:
-                await self.bot.store.set(
-                    f"help/owner/{channel.id}",
-                    creator.id,
-                )
-                await channel.set_permissions(creator, read_messages=True)
+                index.add(channel)
                 return channel
         # We've reached the max number of channels in a server!?
         raise RuntimeError("cannot create a new help channel")
@@ -1,9 +1,68 @@
-"""Provides a message command to forward a request to a specified channel"""
+"""Provides a message command to forward a request to a specified channel
 
+Requests are saved in the store before the user is thanked and forwarded in
+the background. When requests come in faster than they can be sent, pending
+requests of the same type are packed into as few messages as possible.
+
+Before a request is sent, it's claimed in the store with compare_and_set, so
+a request loaded by more than one cog (like after a reload or from another
+worker) is only sent by one of them.
+
+"""
+
+import asyncio
+import json
+import time
+import traceback
+import uuid
 from discord.ext import commands
 
+import store
+
+def pack(prefix, entries, limit=2000):
+    """Yields (content, indices) for messages holding the entries
+
+    Each message starts with the prefix and has an entry per line. An entry
+    too long for a message by itself is split between messages, and only
+    the last one's indices include it.
+
+    Raises ValueError if the prefix leaves no room for the entries.
+
+    """
+    if len(prefix) >= limit - 1:
+        raise ValueError("prefix too long for a message")
+    lines = []
+    indices = []
+    length = len(prefix)
+    for i, entry in enumerate(entries):
+        # The first line is separated from the prefix by a space
+        separator = 1 if prefix or lines else 0
+        if lines and length + separator + len(entry) > limit:
+            yield " ".join(filter(None, [prefix, "\n".join(lines)])), indices
+            lines = []
+            indices = []
+            length = len(prefix)
+            separator = 1 if prefix else 0
+        room = limit - length - separator
+        while len(entry) > room:
+            # Only happens when this is the first line
+            yield " ".join(filter(None, [prefix, entry[:room]])), []
+            entry = entry[room:]
+        lines.append(entry)
+        indices.append(i)
+        length += separator + len(entry)
+    if lines:
+        yield " ".join(filter(None, [prefix, "\n".join(lines)])), indices
+
 class Message(commands.Cog):
     TYPES = tuple("message register hacker".split())
+    # Longest wait before retrying after failing to forward requests
+    MAX_RETRY_DELAY = 60
+    # Longest prefix allowed, so packed messages have room for requests
+    MAX_PREFIX_LENGTH = 1000
+    # Seconds before a claimed request that wasn't sent can be claimed again
+    # (like when the cog claiming it was stopped)
+    CLAIM_TIMEOUT = 600
 
     def __init__(self, bot, *, guild_id, message_channel_id, invite_link):
         self.bot = bot
@@ -12,8 +71,46 @@ class Message(commands.Cog):
         self.message_channel_id = message_channel_id
         self.message_channel = None
         self.invite_link = invite_link
+        # Types mapped to their prefix. They're only cached while the
+        # store's changes to them are being watched.
+        self._prefixes = None
+        self._prefix_watch = None
+        self._prefix_watching = None
+        # The store being watched (bot.store is replaced by moves and reloads)
+        self._prefix_watched_store = None
+        # Changed whenever a prefix changes, so reads in flight then aren't
+        # cached
+        self._prefix_version = 0
+        # Identifies this cog's claims on requests
+        self._owner = uuid.uuid4().hex
+        # Queued requests as (key, type, entry, time queued, value) tuples.
+        # The value is what's in the store, for claiming the request.
+        self._queue = []
+        # Keys of requests claimed by this cog mapped to (value, time claimed)
+        self._claimed = {}
+        # Requests being forwarded right now
+        self._forwarding = []
+        # Keys of sent requests that still need to be deleted from the store
+        self._sent_keys = []
+        self._queued = asyncio.Event()
+        # Counters shown by $_queue_stats
+        self.forwarded = 0
+        self.messages_sent = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+        self._forwarder = bot.loop.create_task(self._forward_queued())
+
+    def cog_unload(self):
+        # Queued requests stay in the store and are sent once reloaded
+        self._forwarder.cancel()
+        if self._prefix_watch is not None:
+            self._prefix_watch.cancel()
 
     async def cog_before_invoke(self, ctx):
+        self.ensure_channels()
+
+    def ensure_channels(self):
         # Ensures the server exists
         if self.guild is None:
             self.guild = self.bot.get_guild(self.guild_id)
@@ -38,11 +135,7 @@ class Message(commands.Cog):
         if not text:
             await ctx.send("Please add a message to your request")
             return
-        parts = [f"{ctx.author.mention}:", text]
-        prefix = await self.bot.store.get("message/prefix/message")
-        if prefix:
-            parts.insert(0, prefix)
-        await self.message_channel.send(" ".join(parts))
+        await self.enqueue("message", f"{ctx.author.mention}: {text}")
         await ctx.send(
             "Thanks for sending a message!"
             " An organizer will get back to you as soon as possible!"
@@ -67,12 +160,11 @@ class Message(commands.Cog):
         if not text:
             await ctx.send("Please add a message to your request")
             return
-        parts = [f"{ctx.author.mention}:", text]
-        prefix = await self.bot.store.get("message/prefix/register")
-        if prefix:
-            parts.insert(0, prefix)
-        await self.message_channel.send(" ".join(parts))
-        await self.bot.store.set(f"message/register/{ctx.author.id}", "1")
+        await self.enqueue(
+            "register",
+            f"{ctx.author.mention}: {text}",
+            f"message/register/{ctx.author.id}",
+        )
         await ctx.send(
             "Thanks for helping out with ULHacks!"
             " An organizer will help get you set up as soon as possible!"
@@ -96,12 +188,11 @@ class Message(commands.Cog):
                 " through?`)"
             )
             return
-        parts = [ctx.author.mention]
-        prefix = await self.bot.store.get("message/prefix/hacker")
-        if prefix:
-            parts.insert(0, prefix)
-        await self.message_channel.send(" ".join(parts))
-        await self.bot.store.set(f"message/hacker/{ctx.author.id}", "1")
+        await self.enqueue(
+            "hacker",
+            ctx.author.mention,
+            f"message/hacker/{ctx.author.id}",
+        )
         await ctx.send(
             "Thanks for participating in ULHacks!"
             " An organizer will verify you as soon as possible!"
@@ -121,12 +212,270 @@ class Message(commands.Cog):
         elif prefix == '""':
             # Clear prefix
             await self.bot.store.set(f"message/prefix/{type_}", "")
+            self._prefix_version += 1
+            self._prefixes = None
             await ctx.send(f"Cleared the {type_} prefix")
+        elif len(prefix) > self.MAX_PREFIX_LENGTH:
+            await ctx.send(
+                f"The prefix can't be longer than {self.MAX_PREFIX_LENGTH}"
+                " characters"
+            )
         else:
             # Update prefix
             await self.bot.store.set(f"message/prefix/{type_}", prefix)
+            self._prefix_version += 1
+            self._prefixes = None
             await ctx.send(f"Updated the {type_} prefix to: {prefix}")
 
+    @commands.command()
+    @commands.is_owner()
+    async def _queue_stats(self, ctx):
+        """Shows the forwarding queue's depth and latency"""
+        average = self.total_latency / self.forwarded if self.forwarded else 0
+        await ctx.send(
+            f"Queued: {len(self._queue)}, forwarding: {len(self._forwarding)}."
+            f" Forwarded {self.forwarded} requests in {self.messages_sent}"
+            f" messages. Latency: last {self.last_latency:.2f}s, average"
+            f" {average:.2f}s, max {self.max_latency:.2f}s"
+        )
+
+    async def get_prefixes(self):
+        """Returns the types mapped to their prefix
+
+        They're cached until the store's watch sees them change.
+
+        """
+        cacheable = self._ensure_watching_prefixes()
+        if self._prefixes is not None:
+            return self._prefixes
+        version = self._prefix_version
+        prefixes = await self.bot.store.get_many(
+            f"message/prefix/{type_}" for type_ in self.TYPES
+        )
+        prefixes = dict(zip(self.TYPES, prefixes))
+        # A prefix could have changed during the read
+        if cacheable and version == self._prefix_version:
+            self._prefixes = prefixes
+        return prefixes
+
+    def _ensure_watching_prefixes(self):
+        # Returns whether prefixes read from now on can be cached
+        if (
+            self._prefix_watch is not None
+            and self._prefix_watched_store is not self.bot.store
+        ):
+            # The old store's watch won't see changes to the new one
+            self._prefix_watch.cancel()
+            self._prefix_watch = None
+            self._prefix_version += 1
+            self._prefixes = None
+        if self._prefix_watch is None:
+            self._prefix_watched_store = self.bot.store
+            self._prefix_watching = asyncio.Event()
+            self._prefix_watch = asyncio.create_task(self._watch_prefixes())
+        return self._prefix_watching.is_set()
+
+    async def _watch_prefixes(self):
+        retry_delay = 0
+        while True:
+            try:
+                async for key in self._prefix_watched_store.watch(
+                    "message/prefix/",
+                    ready=self._prefix_watching,
+                ):
+                    retry_delay = 0
+                    self._prefix_version += 1
+                    self._prefixes = None
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            # Changes could be missed until the watch is restarted
+            self._prefix_watching.clear()
+            self._prefix_version += 1
+            self._prefixes = None
+            retry_delay = min(
+                self.MAX_RETRY_DELAY,
+                max(1, retry_delay * 2),
+            )
+            await asyncio.sleep(retry_delay)
+
+    async def enqueue(self, type_, entry, *flags):
+        """Saves the request in the store and queues it to be forwarded
+
+        Returns once the request is saved. The flag keys are set to "1" in
+        the same write.
+
+        """
+        # Keys sort in the order requests were queued
+        key = f"message/queue/{time.time_ns():020}-{uuid.uuid4().hex}"
+        queued_at = time.time()
+        value = json.dumps([type_, entry, queued_at])
+        await self.bot.store.set_many([
+            (key, value),
+            *((flag, "1") for flag in flags),
+        ])
+        self._queue.append((key, type_, entry, queued_at, value))
+        self._queued.set()
+
+    async def _load_queue(self):
+        """Queues requests left in the store that no one else has claimed
+
+        Returns when to load the queue again to check the skipped requests'
+        claims, or None if no requests were skipped.
+
+        """
+        # Direct messages (where requests come from) go to shard 0, so only
+        # that bot loads requests left over from before
+        if 0 not in (getattr(self.bot, "shard_ids", None) or [0]):
+            return None
+        keys = []
+        async for batch in store.batched(
+            self.bot.store.keys("message/queue/*"),
+            100,
+        ):
+            keys.extend(batch)
+        known = {key for key, *_ in self._queue}
+        known.update(self._sent_keys)
+        known.update(self._claimed)
+        requests = []
+        now = time.time()
+        reload_at = None
+        for key, value in zip(keys, await self.bot.store.get_many(keys)):
+            if not value or key in known:
+                continue
+            try:
+                type_, entry, queued_at, *claim = json.loads(value)
+                if claim:
+                    owner, claimed_at = claim
+            except (ValueError, TypeError):
+                print(f"Dropping queued request {key} that can't be read")
+                self._sent_keys.append(key)
+                continue
+            if claim and claimed_at + self.CLAIM_TIMEOUT > now:
+                # Another cog could be sending it right now
+                expires = claimed_at + self.CLAIM_TIMEOUT
+                reload_at = expires if reload_at is None else min(
+                    reload_at,
+                    expires,
+                )
+                continue
+            requests.append((key, type_, entry, queued_at, value))
+        self._queue[:0] = sorted(requests)
+        if self._queue or self._sent_keys:
+            self._queued.set()
+        return reload_at
+
+    async def _forward_queued(self):
+        await self.bot.wait_until_ready()
+        retry_delay = 0
+        loaded = False
+        # When to load the queue again (see _load_queue)
+        reload_at = None
+        # Start by loading (and sending) requests left over from before
+        self._queued.set()
+        while True:
+            timeout = None
+            if reload_at is not None:
+                timeout = max(0, reload_at - time.time())
+            try:
+                await asyncio.wait_for(self._queued.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if not loaded or (
+                    reload_at is not None and reload_at <= time.time()
+                ):
+                    reload_at = await self._load_queue()
+                    loaded = True
+                await self._delete_sent()
+                self.ensure_channels()
+                # Take everything queued so far. Requests queued while these
+                # are sent are packed together next time.
+                requests, self._queue = self._queue, []
+                self._forwarding = requests
+                try:
+                    await self._forward(requests)
+                finally:
+                    # Put back what wasn't sent
+                    self._queue[:0] = requests
+                    self._forwarding = []
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                retry_delay = min(
+                    self.MAX_RETRY_DELAY,
+                    max(1, retry_delay * 2),
+                )
+                await asyncio.sleep(retry_delay)
+                continue
+            retry_delay = 0
+            if not self._queue:
+                self._queued.clear()
+
+    async def _claim(self, requests):
+        # Claims the requests so no one else sends them. Removes requests
+        # that someone else claimed or that can't be sent from the list.
+        for request in list(requests):
+            key, type_, entry, queued_at, value = request
+            if type_ not in self.TYPES:
+                print(
+                    f"Dropping queued request {key} with unknown type"
+                    f" {type_!r}"
+                )
+                requests.remove(request)
+                self._sent_keys.append(key)
+                continue
+            now = time.time()
+            if key in self._claimed:
+                value, claimed_at = self._claimed[key]
+                # Renew old claims before anyone else can take them over
+                if claimed_at + self.CLAIM_TIMEOUT / 2 > now:
+                    continue
+            claimed = json.dumps([type_, entry, queued_at, self._owner, now])
+            if await self.bot.store.compare_and_set(key, value, claimed):
+                self._claimed[key] = (claimed, now)
+            else:
+                self._claimed.pop(key, None)
+                requests.remove(request)
+
+    async def _forward(self, requests):
+        # Removes requests from the list as they're sent
+        await self._claim(requests)
+        await self._delete_sent()
+        prefixes = await self.get_prefixes()
+        for type_ in self.TYPES:
+            of_type = [request for request in requests if request[1] == type_]
+            if not of_type:
+                continue
+            entries = [request[2] for request in of_type]
+            for content, indices in pack(prefixes[type_] or "", entries):
+                await self.message_channel.send(content)
+                self.messages_sent += 1
+                sent = [of_type[i] for i in indices]
+                if not sent:
+                    continue
+                # Sent requests aren't put back even if deleting them fails
+                now = time.time()
+                for request in sent:
+                    requests.remove(request)
+                    self._sent_keys.append(request[0])
+                    latency = max(0.0, now - request[3])
+                    self.forwarded += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                    self.last_latency = latency
+                await self._delete_sent()
+
+    async def _delete_sent(self):
+        # Retried before the next forward if it fails
+        if self._sent_keys:
+            await self.bot.store.delete_many(self._sent_keys)
+            for key in self._sent_keys:
+                self._claimed.pop(key, None)
+            self._sent_keys = []
+
 def setup(bot):
     bot.add_cog(Message(
         bot,
@@ -1,14 +1,59 @@
 """Provides utilities for having an up to date list of available moderators"""
 
+import asyncio
 import contextlib
+import traceback
 import discord
 from discord.ext import commands
 
+class ModeratorIndex:
+    """A guild's moderator roles and online moderators kept in memory"""
+
+    def __init__(self, role_names, role_ids, online_ids):
+        # Uppercased role names from the store
+        self.role_names = role_names
+        # IDs of the guild's roles with those names
+        self.role_ids = role_ids
+        # IDs of the moderators in the store's online set
+        self.online_ids = online_ids
+
+    def should_show(self, member):
+        """Returns whether the member is an online moderator"""
+        return (
+            member.status != discord.Status.offline
+            and any(role.id in self.role_ids for role in member.roles)
+        )
+
 class Moderators(commands.Cog):
     DEFAULT_ALLOFFLINE = "*No moderators are currently available.*"
+    # Minimum number of seconds between scheduled edits of a guild's message
+    DEFAULT_INTERVAL = 5
 
     def __init__(self, bot):
         self.bot = bot
+        # Guild IDs mapped to the task migrating their online list
+        self._migrations = {}
+        # Guild IDs mapped to the task loading their moderator index
+        self._indexes = {}
+        # Guild IDs mapped to the task running their scheduled updates
+        self._updates = {}
+        # Guild IDs with an update scheduled that hasn't started yet
+        self._dirty = set()
+        # Guild IDs mapped to when their last scheduled update started
+        self._last_updates = {}
+        # Guild IDs mapped to the hash of the message's last edited content
+        self._content_hashes = {}
+        # Counters shown by $mods stats
+        self.scheduled = 0
+        self.coalesced = 0
+        self.edited = 0
+        self.skipped = 0
+
+    def cog_unload(self):
+        # Cogs can't wait while unloading, so flush in the background. When
+        # the bot closes, it flushes before unloading (see ulhacks_bot.py).
+        if self._dirty:
+            asyncio.create_task(self.flush())
 
     @commands.group(invoke_without_command=True)
     @commands.has_permissions(manage_guild=True)
@@ -27,11 +72,10 @@ class Moderators(commands.Cog):
     @mods.command()
     async def update(self, ctx):
         """Checks all members and update the message"""
-        # Check all members
-        for member in ctx.guild.members:
-            await self.update_member(member)
-        # Update the message
-        await self.update_message(ctx.guild)
+        # Check all members against the store's data
+        await self.reconcile(ctx.guild)
+        # Update the message even if it seems unchanged
+        await self.update_message(ctx.guild, force=True)
         # Notify that it's updated
         await ctx.send("Updated online moderators list")
 
@@ -67,6 +111,8 @@ class Moderators(commands.Cog):
             if roles == '""':
                 roles = ""
             await self.bot.store.set(f"{key}/roles", roles)
+            # Check all members with the new roles
+            await self.reconcile(ctx.guild)
             await ctx.send(f"Updated this server's mod roles")
             # Update just in case
             with contextlib.suppress(ValueError, LookupError):
@@ -91,53 +137,298 @@ class Moderators(commands.Cog):
             with contextlib.suppress(ValueError, LookupError):
                 await self.update_message(ctx.guild)
 
+    @mods.command()
+    async def interval(self, ctx, seconds: float = None):
+        """Sets or gets the minimum seconds between message updates"""
+        key = f"moderators/{ctx.guild.id}"
+        if seconds is None:
+            seconds = await self.get_interval(ctx.guild)
+            await ctx.send(f"This server's mods message interval is: {seconds}")
+        else:
+            if seconds < 0:
+                await ctx.send("The interval can't be negative")
+                return
+            await self.bot.store.set(f"{key}/interval", str(seconds))
+            await ctx.send(f"Updated this server's mods message interval")
+
+    @mods.command()
+    async def stats(self, ctx):
+        """Shows how many message updates were coalesced or skipped"""
+        await ctx.send(
+            f"Scheduled: {self.scheduled}, coalesced: {self.coalesced},"
+            f" edited: {self.edited}, skipped (unchanged): {self.skipped}"
+        )
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # The online moderators may have changed while the bot was offline
+        await asyncio.gather(*map(self._reconcile_on_ready, self.bot.guilds))
+
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
-        await self.update_member(after)
-        with contextlib.suppress(ValueError, LookupError):
-            await self.update_message(after.guild)
+        # Skip updates that can't change whether the member is shown (like
+        # activities or nicknames) without touching the store
+        offline = discord.Status.offline
+        if (
+            (before.status != offline) == (after.status != offline)
+            and before.roles == after.roles
+        ):
+            return
+        if await self.update_member(after):
+            self.schedule_update(after.guild)
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        await self.update_member(member)
-        with contextlib.suppress(ValueError, LookupError):
-            await self.update_message(member.guild)
+        if await self.update_member(member):
+            self.schedule_update(member.guild)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        await self.remove_member(member)
-        with contextlib.suppress(ValueError, LookupError):
-            await self.update_message(member.guild)
+        if await self.remove_member(member):
+            self.schedule_update(member.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        await self.reconcile_if_moderator_role(role.guild, role.name)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        await self.reconcile_if_moderator_role(role.guild, role.name)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            await self.reconcile_if_moderator_role(
+                after.guild, before.name, after.name,
+            )
 
     async def update_member(self, member):
-        """Updates the store with the member's status"""
+        """Updates the store with the member's status
+
+        Returns whether the member was added to or removed from the online
+        moderators. The store is only written when they were.
+
+        """
         key = f"moderators/{member.guild.id}"
-        # Check if member is a moderator
-        raw_role_names = await self.bot.store.get(f"{key}/roles")
-        role_names = {name.upper() for name in raw_role_names.split()}
-        should_show = (
-            member.status != discord.Status.offline
-            and any(role.name.upper() in role_names for role in member.roles)
-        )
-        # Update online members
-        online_ids = {*(await self.bot.store.get(f"{key}/online")).split()}
+        index = await self.get_index(member.guild)
+        should_show = index.should_show(member)
+        if should_show == (member.id in index.online_ids):
+            return False
+        # Update the index first so later events see this one's result
         if should_show:
-            online_ids.add(str(member.id))
+            index.online_ids.add(member.id)
+            update = self.bot.store.set_add
         else:
-            online_ids.discard(str(member.id))
-        await self.bot.store.set(f"{key}/online", " ".join(online_ids))
+            index.online_ids.discard(member.id)
+            update = self.bot.store.set_remove
+        try:
+            await update(f"{key}/onlineids", member.id)
+        except BaseException:
+            # Load the index from the store next time
+            self.invalidate_index(member.guild)
+            raise
+        return True
 
     async def remove_member(self, member):
-        """Removes the member from the store"""
+        """Removes the member from the store
+
+        Returns whether the member was an online moderator.
+
+        """
         key = f"moderators/{member.guild.id}"
-        # Update online members
-        online_ids = {*(await self.bot.store.get(f"{key}/online")).split()}
-        online_ids.discard(str(member.id))
-        await self.bot.store.set(f"{key}/online", " ".join(online_ids))
+        index = await self.get_index(member.guild)
+        if member.id not in index.online_ids:
+            return False
+        index.online_ids.discard(member.id)
+        try:
+            await self.bot.store.set_remove(f"{key}/onlineids", member.id)
+        except BaseException:
+            self.invalidate_index(member.guild)
+            raise
+        return True
+
+    async def get_index(self, guild):
+        """Returns the guild's moderator index, loading it if needed"""
+        task = self._indexes.get(guild.id)
+        if task is None:
+            task = asyncio.create_task(self._load_index(guild))
+            self._indexes[guild.id] = task
+        try:
+            # Don't cancel the load if the caller is cancelled
+            return await asyncio.shield(task)
+        except Exception:
+            # Try again next time
+            if self._indexes.get(guild.id) is task:
+                del self._indexes[guild.id]
+            raise
+
+    async def _load_index(self, guild):
+        key = f"moderators/{guild.id}"
+        raw_role_names = await self.bot.store.get(f"{key}/roles")
+        role_names = {name.upper() for name in raw_role_names.split()}
+        role_ids = {
+            role.id for role in guild.roles if role.name.upper() in role_names
+        }
+        await self.migrate(guild)
+        online_ids = await self.bot.store.set_members(f"{key}/onlineids")
+        return ModeratorIndex(
+            role_names,
+            role_ids,
+            {int(id) for id in online_ids},
+        )
+
+    def invalidate_index(self, guild):
+        """Makes the next use of the guild's index load it from the store"""
+        self._indexes.pop(guild.id, None)
+
+    async def reconcile(self, guild):
+        """Reloads the guild's index and checks all its members
+
+        The online moderators are found in one pass over the member cache
+        and the differences are written to the store all at once. Returns
+        whether the online moderators changed.
+
+        """
+        key = f"moderators/{guild.id}"
+        self.invalidate_index(guild)
+        index = await self.get_index(guild)
+        online_ids = {
+            member.id for member in guild.members if index.should_show(member)
+        }
+        added = online_ids - index.online_ids
+        removed = index.online_ids - online_ids
+        if not added and not removed:
+            return False
+        index.online_ids = online_ids
+        try:
+            if removed:
+                await self.bot.store.set_remove(f"{key}/onlineids", *removed)
+            if added:
+                await self.bot.store.set_add(f"{key}/onlineids", *added)
+        except BaseException:
+            self.invalidate_index(guild)
+            raise
+        return True
+
+    async def _reconcile_on_ready(self, guild):
+        try:
+            if await self.reconcile(guild):
+                self.schedule_update(guild)
+        except Exception:
+            traceback.print_exc()
+
+    async def reconcile_if_moderator_role(self, guild, *names):
+        """Reconciles the guild if any of the role names are moderator roles"""
+        task = self._indexes.get(guild.id)
+        if (
+            task is None
+            or not task.done()
+            or task.cancelled()
+            or task.exception() is not None
+        ):
+            # The index will see the new roles when it's loaded
+            return
+        role_names = task.result().role_names
+        if any(name.upper() in role_names for name in names):
+            if await self.reconcile(guild):
+                self.schedule_update(guild)
+
+    async def migrate(self, guild):
+        """Moves the guild's old space separated online list into a set
+
+        This only runs once per guild. Other calls wait for it to finish.
+
+        """
+        task = self._migrations.get(guild.id)
+        if task is None:
+            task = asyncio.create_task(self._migrate(guild))
+            self._migrations[guild.id] = task
+        try:
+            # Don't cancel the migration if the caller is cancelled
+            await asyncio.shield(task)
+        except Exception:
+            # Try again next time
+            if self._migrations.get(guild.id) is task:
+                del self._migrations[guild.id]
+            raise
+
+    async def _migrate(self, guild):
+        key = f"moderators/{guild.id}"
+        online_ids = (await self.bot.store.get(f"{key}/online")).split()
+        if online_ids:
+            await self.bot.store.set_add(f"{key}/onlineids", *online_ids)
+            await self.bot.store.set(f"{key}/online", "")
+
+    async def get_interval(self, guild):
+        """Returns the minimum seconds between scheduled message updates"""
+        key = f"moderators/{guild.id}"
+        interval = await self.bot.store.get(f"{key}/interval")
+        return float(interval) if interval else self.DEFAULT_INTERVAL
+
+    def schedule_update(self, guild):
+        """Schedules an update of the guild's message
+
+        Updates scheduled before the pending one starts are coalesced into
+        it. Scheduled updates start at least the guild's interval apart.
+
+        """
+        self.scheduled += 1
+        if guild.id in self._dirty:
+            self.coalesced += 1
+            return
+        self._dirty.add(guild.id)
+        if guild.id not in self._updates:
+            task = asyncio.create_task(self._run_updates(guild))
+            self._updates[guild.id] = task
+
+    async def _run_updates(self, guild):
+        loop = asyncio.get_running_loop()
+        try:
+            while guild.id in self._dirty:
+                try:
+                    interval = await self.get_interval(guild)
+                except ValueError:
+                    interval = self.DEFAULT_INTERVAL
+                except Exception:
+                    traceback.print_exc()
+                    interval = self.DEFAULT_INTERVAL
+                last = self._last_updates.get(guild.id)
+                if last is not None and last + interval > loop.time():
+                    await asyncio.sleep(last + interval - loop.time())
+                # Let the update finish even if flush cancels this task
+                await asyncio.shield(self._flush_guild(guild))
+        finally:
+            if self._updates.get(guild.id) is asyncio.current_task():
+                del self._updates[guild.id]
+
+    async def _flush_guild(self, guild):
+        # Updates scheduled from now on need another update
+        self._dirty.discard(guild.id)
+        self._last_updates[guild.id] = asyncio.get_running_loop().time()
+        try:
+            await self.update_message(guild)
+        except (ValueError, LookupError):
+            pass
+        except Exception:
+            traceback.print_exc()
+
+    async def flush(self):
+        """Runs all scheduled updates now"""
+        for task in self._updates.values():
+            task.cancel()
+        self._updates.clear()
+        guilds = [
+            guild
+            for guild in map(self.bot.get_guild, tuple(self._dirty))
+            if guild is not None
+        ]
+        self._dirty.clear()
+        await asyncio.gather(*map(self._flush_guild, guilds))
 
     async def create_message(self, channel):
         """Creates the message and updates to the store"""
         key = f"moderators/{channel.guild.id}"
+        self._content_hashes.pop(channel.guild.id, None)
         await self.bot.store.set(f"{key}/channel", channel.id)
         message = await channel.send(
             "*Loading...*",
@@ -145,15 +436,20 @@ class Moderators(commands.Cog):
         )
         await self.bot.store.set(f"{key}/message", message.id)
 
-    async def update_message(self, guild):
-        """Updates the message from the store"""
+    async def update_message(self, guild, *, force=False):
+        """Updates the message from the store
+
+        The edit is skipped if the content is the same as the last edit's
+        unless force is True.
+
+        """
         key = f"moderators/{guild.id}"
         # Get message prefix
         prefix = await self.bot.store.get(f"{key}/prefix")
         if prefix:
             prefix += " "
         # Create string with mentions
-        online_ids = {*(await self.bot.store.get(f"{key}/online")).split()}
+        online_ids = (await self.get_index(guild)).online_ids
         if online_ids:
             mentions = ", ".join(f"<@{id}>" for id in sorted(online_ids))
             content = f"{prefix}{mentions}"
@@ -170,12 +466,20 @@ class Moderators(commands.Cog):
         # Get the message
         message_id = int(await self.bot.store.get(f"{key}/message"))
         partial_message = channel.get_partial_message(message_id)
+        # Skip the edit if nothing changed
+        content_hash = hash((channel_id, message_id, content))
+        if not force and self._content_hashes.get(guild.id) == content_hash:
+            self.skipped += 1
+            return
         # Edit the message
         try:
             await partial_message.edit(content=content)
         except discord.NotFound as e:
+            self._content_hashes.pop(guild.id, None)
             error = f"cannot get message with id: {message_id}"
             raise LookupError(error) from e
+        self._content_hashes[guild.id] = content_hash
+        self.edited += 1
 
 def setup(bot):
     bot.add_cog(Moderators(bot))
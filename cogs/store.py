@@ -1,8 +1,14 @@
 """Provides Discord commands to the key-value storage"""
 
-import fnmatch
+import os
+import tempfile
+import time
+import discord
 from discord.ext import commands
 
+import store
+import store.dump
+
 class Paginator:
     def __init__(self, sep=", ", limit=2000):
         self.sep = sep
@@ -44,14 +50,36 @@ class Paginator:
         if page := self.flush():
             yield page
 
+def format_set(members, limit=2000):
+    """Returns the set's members as text shorter than the limit"""
+    text = "{" + ", ".join(sorted(members)) + "}"
+    if len(text) > limit:
+        text = text[:limit - 4] + "...}"
+    return text
+
 class StoreCog(commands.Cog, name="Store"):
     def __init__(self, bot):
         self.bot = bot
 
     async def keys_matching(self, pattern):
-        async for key in self.bot.store.keys():
-            if fnmatch.fnmatchcase(key, pattern):
-                yield key
+        # The store only scans the keys that can match
+        async for key in self.bot.store.keys(pattern):
+            yield key
+
+    async def values_matching(self, pattern):
+        async for keys in store.batched(self.keys_matching(pattern), 100):
+            for value in await self.bot.store.get_many(keys):
+                yield value
+        # Sets are stored separately from values
+        async for key in self.bot.store.set_keys(pattern):
+            yield format_set(await self.bot.store.set_members(key))
+
+    async def all_keys(self, pattern):
+        async for key in self.bot.store.keys(pattern):
+            yield key
+        # Sets are marked so they aren't mistaken for values
+        async for key in self.bot.store.set_keys(pattern):
+            yield f"{key} (set)"
 
     @commands.command(ignore_extra=False)
     @commands.is_owner()
@@ -62,9 +90,9 @@ class StoreCog(commands.Cog, name="Store"):
             return
         pattern = key
         updated = 0
-        async for key in self.keys_matching(pattern):
-            await self.bot.store.set(key, value)
-            updated += 1
+        async for keys in store.batched(self.keys_matching(pattern), 100):
+            await self.bot.store.set_many((key, value) for key in keys)
+            updated += len(keys)
         await ctx.send(f"Updated {updated}")
 
     @commands.command(ignore_extra=False)
@@ -72,13 +100,16 @@ class StoreCog(commands.Cog, name="Store"):
     async def get(self, ctx, key):
         if not any(char in key for char in "*?[]"):
             value = await self.bot.store.get(key)
+            if not value:
+                # It could be a set instead
+                if members := await self.bot.store.set_members(key):
+                    value = format_set(members)
             await ctx.send(value or "*Empty value*")
             return
         pattern = key
         num_pages = 0
         async for page in Paginator().async_pages_from(
-            await self.bot.store.get(key)
-            async for key in self.keys_matching(pattern)
+            self.values_matching(pattern)
         ):
             await ctx.send(page)
             num_pages += 1
@@ -90,14 +121,107 @@ class StoreCog(commands.Cog, name="Store"):
     async def keys(self, ctx, pattern=None):
         num_pages = 0
         async for page in Paginator().async_pages_from(
-            self.keys_matching(pattern)
-            if pattern is not None
-            else self.bot.store.keys()
+            self.all_keys(pattern)
         ):
             await ctx.send(page)
             num_pages += 1
         if num_pages == 0:
             await ctx.send("*No keys match*")
 
+    @commands.command(ignore_extra=False)
+    @commands.is_owner()
+    async def export(self, ctx, extension="gz"):
+        """Sends a file with all of the store's data
+
+        The extension can be gz, zst, or ndjson (uncompressed).
+
+        """
+        if extension not in ("gz", "zst", "ndjson"):
+            await ctx.send("Use `gz`, `zst`, or `ndjson`")
+            return
+        name = "store.ndjson"
+        if extension != "ndjson":
+            name += f".{extension}"
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, name)
+            count = await store.dump.dump(self.bot.store, filename)
+            await ctx.send(
+                f"Exported {count} keys",
+                file=discord.File(filename),
+            )
+
+    @commands.command(name="import", ignore_extra=False)
+    @commands.is_owner()
+    async def import_(self, ctx):
+        """Loads the attached file (from the export command) into the store"""
+        if len(ctx.message.attachments) != 1:
+            await ctx.send("Attach one exported file")
+            return
+        [attachment] = ctx.message.attachments
+        # Keep the extension so the compression is detected
+        name = os.path.basename(attachment.filename)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, name)
+            await attachment.save(filename)
+            count = await store.dump.load(self.bot.store, filename)
+        await ctx.send(f"Imported {count} keys")
+
+    @commands.command(ignore_extra=False)
+    @commands.is_owner()
+    async def storestats(self, ctx, action=None):
+        """Shows or resets statistics about the store's use"""
+        stats = getattr(self.bot, "store_stats", None)
+        if stats is None:
+            await ctx.send("*Store stats are disabled*")
+            return
+        if action == "reset":
+            stats.reset()
+            await ctx.send("Reset store stats")
+            return
+        if action is not None:
+            await ctx.send("Use `reset` or nothing")
+            return
+        num_pages = 0
+        for page in Paginator(sep="\n", limit=1990).pages_from(
+            self.stats_lines(stats)
+        ):
+            await ctx.send(f"```\n{page}\n```")
+            num_pages += 1
+        if num_pages == 0:
+            await ctx.send("*No store operations yet*")
+
+    def stats_lines(self, stats):
+        def row(operation, namespace, histogram):
+            p50, p95, p99 = (
+                histogram.percentile(fraction) * 1000
+                for fraction in (0.5, 0.95, 0.99)
+            )
+            return (
+                f"{operation:<11} {namespace:<12} {histogram.count:>8}"
+                f" {histogram.errors:>6} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}"
+            )
+        if not stats.histograms:
+            return
+        since = time.gmtime(stats.since)
+        since = time.strftime("%Y-%m-%d %H:%M:%S UTC", since)
+        yield f"Since {since} (latencies in ms)"
+        yield (
+            f"{'operation':<11} {'namespace':<12} {'count':>8}"
+            f" {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8}"
+        )
+        for operation, histogram in sorted(stats.by_operation().items()):
+            yield row(operation, "(all)", histogram)
+        for (operation, namespace), histogram in sorted(
+            stats.histograms.items(),
+            key=lambda item: (item[0][0], -item[1].count),
+        ):
+            yield row(operation, namespace, histogram)
+        # Show cache counters from any caching store being wrapped
+        store_ = self.bot.store
+        while store_ is not None:
+            if hasattr(store_, "hits") and hasattr(store_, "misses"):
+                yield f"Cache: {store_.hits} hits, {store_.misses} misses"
+            store_ = getattr(store_, "store", None)
+
 def setup(bot):
     bot.add_cog(StoreCog(bot))
@@ -1,17 +1,176 @@
-"""Sets the data store depending on ULHACKS_ENV"""
+"""Sets the data store depending on ULHACKS_ENV
 
+If ULHACKS_MOVE_FROM_ENV is set, the data is moved from that environment's
+store into ULHACKS_ENV's store on startup. An interrupted move is resumed,
+and a finished one isn't done again.
+
+An environment can be given an argument after a colon. "sharded:16" uses 16
+shards instead of ULHACKS_SHARDED_STORE_SHARDS, so the number of shards can
+be changed by moving from the old number.
+
+"""
+
+import asyncio
 import os
 
-def setup_local(bot):
+def create_local():
     import store.json
     filename = os.environ.get("ULHACKS_JSON_STORE_FILENAME", None)
-    bot.store = store.json.JsonStore(filename=filename)
+    if os.environ.get("ULHACKS_JSON_STORE_RESIDENT", "") not in ("", "0"):
+        flush_delay = os.environ.get("ULHACKS_JSON_STORE_FLUSH_DELAY", None)
+        if flush_delay is not None:
+            flush_delay = float(flush_delay)
+        return store.json.ResidentJsonStore(
+            filename=filename,
+            flush_delay=flush_delay,
+        )
+    else:
+        return store.json.JsonStore(filename=filename)
+
+def create_log():
+    import store.log
+    filename = os.environ.get("ULHACKS_LOG_STORE_FILENAME", None)
+    return store.log.LogStore(filename=filename)
 
-def setup_heroku(bot):
+def create_snapshot():
+    import store.snapshot
+    filename = os.environ.get("ULHACKS_SNAPSHOT_STORE_FILENAME", None)
+    return store.snapshot.SnapshotStore(filename=filename)
+
+def create_sqlite():
+    import store.sqlite
+    filename = os.environ.get("ULHACKS_SQLITE_STORE_FILENAME", None)
+    return store.sqlite.SqliteStore(filename=filename)
+
+def create_sharded(shards=None):
+    import store.sharded
+    directory = os.environ.get("ULHACKS_SHARDED_STORE_DIRECTORY", None)
+    if shards is None:
+        shards = os.environ.get("ULHACKS_SHARDED_STORE_SHARDS", None)
+    if shards is not None and shards != "namespace":
+        shards = int(shards)
+    return store.sharded.ShardedJsonStore(directory=directory, shards=shards)
+
+def create_heroku():
     import store.postgresql
     address = os.environ["DATABASE_URL"]
-    bot.store = store.postgresql.PostgresqlStore(address=address)
+    min_size = os.environ.get("ULHACKS_POSTGRESQL_POOL_MIN_SIZE", None)
+    if min_size is not None:
+        min_size = int(min_size)
+    max_size = os.environ.get("ULHACKS_POSTGRESQL_POOL_MAX_SIZE", None)
+    if max_size is not None:
+        max_size = int(max_size)
+    return store.postgresql.PostgresqlStore(
+        address=address,
+        min_size=min_size,
+        max_size=max_size,
+    )
+
+def create_store(env=None):
+    """Returns a new store for the environment (defaults to ULHACKS_ENV)"""
+    if env is None:
+        env = os.environ.get("ULHACKS_ENV", "local")
+    env, colon, arg = env.partition(":")
+    if colon:
+        return globals()[f"create_{env}"](arg)
+    return globals()[f"create_{env}"]()
+
+def check_shared(env=None):
+    """Raises RuntimeError if the store config can't be used by several
+    processes at once (see ulhacks_bot.run_cluster)"""
+    store_ = create_store(env)
+    if not store_.shared:
+        raise RuntimeError(
+            f"{type(store_).__name__} can only be used by one process."
+            f" Use the heroku or sqlite environment instead."
+        )
+    if os.environ.get("ULHACKS_MOVE_FROM_ENV", ""):
+        raise RuntimeError(
+            "Every process would move the data on startup. Move it with a"
+            " single process first."
+        )
+    capacity = int(os.environ.get("ULHACKS_STORE_CACHE_SIZE", "0"))
+    if capacity > 0 and "ULHACKS_STORE_CACHE_TTL" not in os.environ:
+        # Only PostgreSQL tells other processes about changes
+        import store.postgresql
+        watch = os.environ.get("ULHACKS_STORE_CACHE_WATCH", "")
+        if not (
+            watch not in ("", "0")
+            and isinstance(store_, store.postgresql.PostgresqlStore)
+        ):
+            raise RuntimeError(
+                "Cached values would never see other processes' changes."
+                " Set ULHACKS_STORE_CACHE_TTL (or ULHACKS_STORE_CACHE_WATCH"
+                " with the heroku environment)."
+            )
+
+async def move_on_startup(move_store, ready=None):
+    if ready is not None:
+        await asyncio.wait([ready])
+    if await move_store.move():
+        print(f"Moved {move_store.total} keys into the new store")
+    else:
+        print("The data was already moved. Unset ULHACKS_MOVE_FROM_ENV.")
 
 def setup(bot):
-    env = os.environ.get("ULHACKS_ENV", "local")
-    globals()[f"setup_{env}"](bot)
+    bot.store = create_store()
+    from_env = os.environ.get("ULHACKS_MOVE_FROM_ENV", "")
+    if from_env:
+        import store.move
+        bot.store = store.move.MoveStore(create_store(from_env), bot.store)
+    move_store = bot.store
+    # When reloading, wait for the old store to finish closing (see teardown)
+    closing = getattr(bot, "store_closing", None)
+    if closing is not None and closing.done():
+        closing = None
+    if closing is not None:
+        import store.waiting
+        bot.store = store.waiting.WaitingStore(bot.store, closing)
+    if from_env:
+        bot.loop.create_task(move_on_startup(move_store, closing))
+    bot.store = wrap_store(bot, bot.store)
+
+def wrap_store(bot, store_, *, cache=True):
+    """Returns the store wrapped with the cache and stats from the environment
+
+    The cache is left out if cache is False.
+
+    """
+    capacity = int(os.environ.get("ULHACKS_STORE_CACHE_SIZE", "0"))
+    if cache and capacity > 0:
+        import store.cache
+        ttl = os.environ.get("ULHACKS_STORE_CACHE_TTL", None)
+        if ttl is not None:
+            ttl = float(ttl)
+        watch = os.environ.get("ULHACKS_STORE_CACHE_WATCH", "")
+        store_ = store.cache.CachingStore(
+            store_,
+            capacity=capacity,
+            ttl=ttl,
+            watch=watch not in ("", "0"),
+        )
+    if os.environ.get("ULHACKS_STORE_STATS", "1") not in ("", "0"):
+        import store.stats
+        # Keep the stats on the bot so they survive reloads
+        if not hasattr(bot, "store_stats"):
+            bot.store_stats = store.stats.StoreStats()
+        store_ = store.stats.InstrumentedStore(store_, bot.store_stats)
+    return store_
+
+def unwrap_store(store_):
+    """Returns the store without the wrappers added by wrap_store"""
+    import store.cache
+    import store.stats
+    while isinstance(
+        store_,
+        (store.cache.CachingStore, store.stats.InstrumentedStore),
+    ):
+        store_ = store_.store
+    return store_
+
+def teardown(bot):
+    # Extensions can't await while being unloaded, so the store is closed in
+    # the background. The next setup and the bot's close wait for it.
+    store_ = bot.store
+    del bot.store
+    bot.store_closing = bot.loop.create_task(store_.close())
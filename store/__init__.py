@@ -3,13 +3,161 @@
 An abstract class is provided for implementations to follow.
 
 """
-from collections.abc import AsyncIterator
+import asyncio
+# Importing the store.json module would replace a plain "json" name
+import json as _json
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+from typing import AbstractSet, Optional
 
 class Store:
+    # Whether several processes can use the same store at once (like when
+    # the bot runs in cluster mode)
+    shared: bool = False
     async def set(self, key: str, value: str) -> None:
         raise NotImplementedError
     async def get(self, key: str) -> str:
         raise NotImplementedError
-    # Used to move data between stores. Can be slow / inefficient
-    async def keys(self) -> AsyncIterator[str]:
+    # Used to move data between stores. Can be slow / inefficient. If pattern
+    # is given, only keys matching it (see fnmatch.fnmatchcase) are yielded
+    async def keys(self, pattern: Optional[str] = None) -> AsyncIterator[str]:
         raise NotImplementedError
+    # Called when the bot closes. Stores holding resources or pending writes
+    # should release or flush them here
+    async def close(self) -> None:
+        pass
+    # Batch versions of .get and .set. Stores should override these when they
+    # can do them in fewer round trips or file rewrites
+    async def get_many(self, keys: Iterable[str]) -> list[str]:
+        return [await self.get(key) for key in keys]
+    async def set_many(self, items: Iterable[tuple[str, str]]) -> None:
+        for key, value in items:
+            await self.set(key, value)
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        await self.set_many((key, "") for key in keys)
+    # Atomic operations. .incr treats "" as 0 and returns the new number.
+    # .compare_and_set only sets the key if its value is expected and returns
+    # whether it did. The defaults are only atomic with respect to each other
+    # on the same store object, so stores should override them.
+    async def incr(self, key: str, delta: int = 1) -> int:
+        async with self._atomic_lock():
+            number = int(await self.get(key) or "0") + delta
+            await self.set(key, str(number))
+            return number
+    async def compare_and_set(self, key: str, expected: str, new: str) -> bool:
+        async with self._atomic_lock():
+            if await self.get(key) != str(expected):
+                return False
+            await self.set(key, new)
+            return True
+    # Set operations. Sets are stored separately from values in stores that
+    # support them, so a key shouldn't be used for both. The defaults store a
+    # set as a JSON list value under its key (and .set_keys yields nothing as
+    # .keys already includes them).
+    async def set_add(self, key: str, *members: str) -> None:
+        async with self._atomic_lock():
+            current = await self.set_members(key)
+            new = current | {str(member) for member in members}
+            if new != current:
+                await self.set(key, _json.dumps(sorted(new)))
+    async def set_remove(self, key: str, *members: str) -> None:
+        async with self._atomic_lock():
+            current = await self.set_members(key)
+            new = current - {str(member) for member in members}
+            if new != current:
+                await self.set(key, _json.dumps(sorted(new)) if new else "")
+    async def set_members(self, key: str) -> AbstractSet[str]:
+        value = await self.get(key)
+        return set(_json.loads(value)) if value else set()
+    # Used to move sets between stores
+    async def set_keys(
+        self,
+        pattern: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        return
+        yield
+    # Yields keys starting with prefix (values or sets) as they're changed,
+    # starting once the iterator is first awaited. If ready is given, it's
+    # set once changes are being watched. If changes could have been missed
+    # (like when a connection is lost), the iterator raises ConnectionError
+    # and has to be restarted. The default only sees changes passed to
+    # ._notify, which local stores call after each write. Stores shared
+    # between processes should override this.
+    async def watch(
+        self,
+        prefix: str = "",
+        *,
+        ready: Optional[asyncio.Event] = None,
+    ) -> AsyncIterator[str]:
+        watchers = self.__dict__.setdefault("_default_watchers", set())
+        watcher = (prefix, asyncio.Queue())
+        watchers.add(watcher)
+        if ready is not None:
+            ready.set()
+        try:
+            while True:
+                key = await watcher[1].get()
+                if isinstance(key, BaseException):
+                    raise key
+                yield key
+        finally:
+            watchers.discard(watcher)
+    def _notify(self, keys: Iterable[str]) -> None:
+        watchers = self.__dict__.get("_default_watchers")
+        if not watchers:
+            return
+        for key in keys:
+            for prefix, queue in watchers:
+                if key.startswith(prefix):
+                    queue.put_nowait(key)
+    # Makes every current .watch() iterator raise the error
+    def _fail_watchers(self, error: BaseException) -> None:
+        for prefix, queue in self.__dict__.get("_default_watchers", ()):
+            queue.put_nowait(error)
+    def _atomic_lock(self) -> asyncio.Lock:
+        lock = self.__dict__.get("_default_atomic_lock")
+        if lock is None:
+            lock = self._default_atomic_lock = asyncio.Lock()
+        return lock
+
+async def batched(
+    iterable: AsyncIterable[str],
+    size: int,
+) -> AsyncIterator[list[str]]:
+    """Yields lists of up to size items from the async iterable"""
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def pattern_prefix(pattern: Optional[str]) -> str:
+    """Returns the literal part of the pattern before any wildcards
+
+    All keys matching the pattern start with the returned prefix.
+
+    """
+    if pattern is None:
+        return ""
+    for i, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:i]
+    return pattern
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """Returns the smallest string larger than all strings with the prefix
+
+    Returns None if there is no such string (like when prefix is empty).
+
+    """
+    # Strip characters that can't be incremented
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    # Surrogates can't be encoded so skip over them
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix[:-1] + chr(code)
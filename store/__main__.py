@@ -0,0 +1,64 @@
+"""Dumps, loads, or watches a store's data outside of the bot
+
+Usage:
+
+    python -m store dump FILE [--env ENV] [--batch-size N]
+    python -m store load FILE [--env ENV] [--batch-size N]
+    python -m store watch [PREFIX] [--env ENV]
+
+The store is created the same way as the bot does (see extensions/store.py)
+so the same environment variables apply. ENV defaults to ULHACKS_ENV. Files
+ending in ".gz" or ".zst" are compressed.
+
+Watching prints each changed key starting with PREFIX until interrupted.
+Only stores shared between processes (like heroku) see the bot's changes.
+
+"""
+import argparse
+import asyncio
+
+from . import dump
+
+async def run(args):
+    from extensions.store import create_store
+    store = create_store(args.env)
+    try:
+        if args.action == "dump":
+            count = await dump.dump(
+                store,
+                args.filename,
+                batch_size=args.batch_size,
+            )
+            print(f"Dumped {count} keys into {args.filename}")
+        elif args.action == "load":
+            count = await dump.load(
+                store,
+                args.filename,
+                batch_size=args.batch_size,
+            )
+            print(f"Loaded {count} keys from {args.filename}")
+        else:
+            async for key in store.watch(args.prefix):
+                print(key, flush=True)
+    finally:
+        await store.close()
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m store")
+    actions = parser.add_subparsers(dest="action", required=True)
+    for action in ("dump", "load"):
+        subparser = actions.add_parser(action)
+        subparser.add_argument("filename")
+        subparser.add_argument("--env", default=None)
+        subparser.add_argument("--batch-size", type=int, default=None)
+    subparser = actions.add_parser("watch")
+    subparser.add_argument("prefix", nargs="?", default="")
+    subparser.add_argument("--env", default=None)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
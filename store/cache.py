@@ -0,0 +1,220 @@
+"""Provides a wrapper that caches another store's values in memory"""
+
+import asyncio
+import collections
+import time
+import traceback
+
+from . import Store
+
+class CachingStore(Store):
+    """This class wraps another store with a read-through cache
+
+    Up to .capacity values are kept, evicting the least recently used one
+    first. If .ttl is set, values older than .ttl seconds are read again.
+    Empty values ("") are cached too unless .negative is False.
+
+    Writes through this class update the cache. Writes made to the wrapped
+    store directly (or by another process) are only seen once the cached
+    value expires, unless watch=True is passed. Then changed keys are
+    removed from the cache as the wrapped store's .watch() sees them. Values
+    are only cached while the watch is running, and the cache is cleared
+    whenever it stops (like when its connection is lost).
+
+    Sets aren't cached. Set operations are passed to the wrapped store.
+
+    The .hits and .misses attributes count the keys read from the cache and
+    from the wrapped store.
+
+    """
+    DEFAULT_CAPACITY = 1024
+    # Longest wait before restarting a failed watch
+    MAX_WATCH_RETRY_DELAY = 60
+
+    def __init__(
+        self,
+        store,
+        *,
+        capacity=None,
+        ttl=None,
+        negative=True,
+        watch=False,
+    ):
+        if capacity is None:
+            capacity = type(self).DEFAULT_CAPACITY
+        self.store = store
+        self.capacity = capacity
+        self.ttl = ttl
+        self.negative = negative
+        self.watch_changes = watch
+        self._watch_task = None
+        # Set once the wrapped store is being watched
+        self._watching = None
+        self.hits = 0
+        self.misses = 0
+        # Maps keys to (value, expiry time or None)
+        self.cache = collections.OrderedDict()
+        # Changed before and after each write. Reads that were in flight
+        # during a write could have gotten the old value and aren't cached.
+        self._version = 0
+
+    def _lookup(self, key):
+        # Returns the cached value or None if it isn't cached
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry is not None and expiry <= time.monotonic():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return value
+
+    def _remember(self, key, value):
+        # Without a running watch, other processes' changes would be missed
+        watching = self._watching is not None and self._watching.is_set()
+        if (not value and not self.negative) or (
+            self.watch_changes and not watching
+        ):
+            self.cache.pop(key, None)
+            return
+        expiry = None
+        if self.ttl is not None:
+            expiry = time.monotonic() + self.ttl
+        self.cache[key] = (value, expiry)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def _ensure_watching(self):
+        # Returns whether values read from now on can be cached
+        if not self.watch_changes:
+            return True
+        if self._watch_task is None:
+            self._watching = asyncio.Event()
+            self._watch_task = asyncio.create_task(self._invalidate())
+        return self._watching.is_set()
+
+    async def _invalidate(self):
+        retry_delay = 0
+        while True:
+            try:
+                async for key in self.store.watch(ready=self._watching):
+                    self._version += 1
+                    self.cache.pop(key, None)
+                    retry_delay = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+            # Changes could be missed until the watch is restarted
+            self._watching.clear()
+            self.clear()
+            retry_delay = min(
+                self.MAX_WATCH_RETRY_DELAY,
+                max(1, retry_delay * 2),
+            )
+            await asyncio.sleep(retry_delay)
+
+    def clear(self):
+        """Removes all cached values"""
+        self._version += 1
+        self.cache.clear()
+
+    async def get(self, key):
+        cacheable = self._ensure_watching()
+        key = str(key)
+        value = self._lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        version = self._version
+        value = await self.store.get(key)
+        if cacheable and self._version == version:
+            self._remember(key, value)
+        return value
+
+    async def get_many(self, keys):
+        cacheable = self._ensure_watching()
+        keys = [str(key) for key in keys]
+        values = [self._lookup(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            version = self._version
+            found = dict(zip(missing, await self.store.get_many(missing)))
+            if cacheable and self._version == version:
+                for key, value in found.items():
+                    self._remember(key, value)
+            values = [
+                found[key] if value is None else value
+                for key, value in zip(keys, values)
+            ]
+        return values
+
+    async def set(self, key, value):
+        key, value = str(key), str(value)
+        self._version += 1
+        self.cache.pop(key, None)
+        await self.store.set(key, value)
+        self._version += 1
+        self._remember(key, value)
+
+    async def set_many(self, items):
+        items = [(str(key), str(value)) for key, value in items]
+        self._version += 1
+        for key, value in items:
+            self.cache.pop(key, None)
+        await self.store.set_many(items)
+        self._version += 1
+        for key, value in items:
+            self._remember(key, value)
+
+    async def incr(self, key, delta=1):
+        key = str(key)
+        self._version += 1
+        self.cache.pop(key, None)
+        number = await self.store.incr(key, delta)
+        self._version += 1
+        self._remember(key, str(number))
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        key, new = str(key), str(new)
+        self._version += 1
+        self.cache.pop(key, None)
+        succeeded = await self.store.compare_and_set(key, expected, new)
+        self._version += 1
+        # We don't know the value if it failed
+        if succeeded:
+            self._remember(key, new)
+        return succeeded
+
+    async def set_add(self, key, *members):
+        await self.store.set_add(key, *members)
+
+    async def set_remove(self, key, *members):
+        await self.store.set_remove(key, *members)
+
+    async def set_members(self, key):
+        return await self.store.set_members(key)
+
+    async def keys(self, pattern=None):
+        async for key in self.store.keys(pattern):
+            yield key
+
+    async def set_keys(self, pattern=None):
+        async for key in self.store.set_keys(pattern):
+            yield key
+
+    async def watch(self, prefix="", *, ready=None):
+        async for key in self.store.watch(prefix, ready=ready):
+            yield key
+
+    async def close(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        await self.store.close()
@@ -0,0 +1,109 @@
+"""Provides streaming export and import of a store's data
+
+The data is written as newline delimited JSON with a record per line. Values
+are [key, value] records and sets are [key, [members...]] records. Files
+ending in ".gz" are gzip compressed and files ending in ".zst" are zstd
+compressed (which needs the zstandard package).
+
+Only a batch of records is held in memory at once, so any amount of data
+can be dumped or loaded.
+
+"""
+
+import asyncio
+import gzip
+import itertools
+import json
+import os
+
+from . import batched
+
+DEFAULT_BATCH_SIZE = 1000
+
+def open_file(filename, mode="r"):
+    """Opens the file as text, compressing it depending on its extension"""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    if filename.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError("zstandard is needed for .zst files") from e
+        return zstandard.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+def _record(*fields):
+    return json.dumps(fields, separators=",:") + "\n"
+
+async def dump(store, filename, *, batch_size=None):
+    """Writes all of the store's data to the file and returns the key count
+
+    The file is written to a temporary file first and only replaces the
+    actual file once it's complete.
+
+    """
+    if batch_size is None:
+        batch_size = DEFAULT_BATCH_SIZE
+    # Keep the extension so the temporary file gets the same compression
+    head, tail = os.path.split(filename)
+    temp_filename = os.path.join(head, f".tmp-{tail}")
+    file = await asyncio.to_thread(open_file, temp_filename, "w")
+    count = 0
+    try:
+        async for keys in batched(store.keys(), batch_size):
+            values = await store.get_many(keys)
+            lines = [
+                _record(key, value)
+                for key, value in zip(keys, values)
+                # Skip keys deleted since they were listed
+                if value
+            ]
+            await asyncio.to_thread(file.writelines, lines)
+            count += len(lines)
+        async for keys in batched(store.set_keys(), batch_size):
+            lines = []
+            for key in keys:
+                members = await store.set_members(key)
+                if members:
+                    lines.append(_record(key, sorted(members)))
+            await asyncio.to_thread(file.writelines, lines)
+            count += len(lines)
+    except BaseException:
+        await asyncio.to_thread(file.close)
+        await asyncio.to_thread(os.unlink, temp_filename)
+        raise
+    await asyncio.to_thread(file.close)
+    await asyncio.to_thread(os.replace, temp_filename, filename)
+    return count
+
+async def load(store, filename, *, batch_size=None):
+    """Writes the file's data into the store and returns the key count
+
+    Existing keys that aren't in the file are left alone. Set members are
+    added to any existing members.
+
+    """
+    if batch_size is None:
+        batch_size = DEFAULT_BATCH_SIZE
+    file = await asyncio.to_thread(open_file, filename, "r")
+    count = 0
+    try:
+        while True:
+            lines = await asyncio.to_thread(
+                lambda: list(itertools.islice(file, batch_size))
+            )
+            if not lines:
+                break
+            items = []
+            for line in lines:
+                key, value = json.loads(line)
+                if isinstance(value, list):
+                    await store.set_add(key, *value)
+                else:
+                    items.append((key, value))
+            if items:
+                await store.set_many(items)
+            count += len(lines)
+    finally:
+        await asyncio.to_thread(file.close)
+    return count
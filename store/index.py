@@ -0,0 +1,43 @@
+"""Provides a sorted index of keys for prefix and pattern scans"""
+
+import bisect
+import fnmatch
+
+from . import pattern_prefix
+
+class KeyIndex:
+    """This class keeps keys in a sorted list
+
+    Adding and removing keys uses binary search. Scanning for a pattern only
+    looks at the keys starting with the pattern's literal prefix.
+
+    """
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self.keys.insert(i, key)
+
+    def discard(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def scan(self, pattern=None):
+        """Returns a list of keys matching the pattern in sorted order"""
+        if pattern is None:
+            return list(self.keys)
+        prefix = pattern_prefix(pattern)
+        matches = []
+        for i in range(bisect.bisect_left(self.keys, prefix), len(self.keys)):
+            key = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(key, pattern):
+                matches.append(key)
+        return matches
@@ -2,15 +2,20 @@
 
 import json
 import asyncio
+import fnmatch
 import os
+import traceback
 
 from . import Store
+from .index import KeyIndex
 
 class JsonStore(Store):
     """This class uses a JSON encoded file
 
     The file is read on each .get call and rewritten on each .set call.
 
+    Values are stored as strings and sets are stored as lists of strings.
+
     """
     DEFAULT_FILENAME = "json-store.json"
 
@@ -20,60 +25,327 @@ class JsonStore(Store):
         self.filename = filename
         self.lock = None
 
-    async def set(self, key, value):
-        if self.lock is None:
-            self.lock = asyncio.Lock()
-        async with self.lock:
-            await asyncio.to_thread(self._set, key, value)
-
-    def _set(self, key, value):
+    def _load(self):
         # Get data from the file if it exists
         try:
             with open(self.filename) as file:
-                data = json.load(file)
+                raw = json.load(file)
         except FileNotFoundError:
-            data = {}
-        # Don't store empty string values
-        key, value = str(key), str(value)
-        if not value:
-            data.pop(key, None)
-        else:
-            data[key] = value
+            raw = {}
+        # Split the values from the sets
+        data = {}
+        sets = {}
+        for key, value in raw.items():
+            if isinstance(value, list):
+                sets[key] = set(value)
+            else:
+                data[key] = value
+        return data, sets
+
+    def _dump(self, data, sets):
+        raw = dict(data)
+        for key, members in sets.items():
+            raw[key] = sorted(members)
         # Write to a temporary file before atomically replacing the actual file
         temp_filename = self.filename + ".tmp"
         with open(temp_filename, mode="w") as file:
-            json.dump(data, file, separators=",:")
+            json.dump(raw, file, separators=",:")
         os.replace(temp_filename, self.filename)
 
-    async def get(self, key):
+    async def _run(self, func, *args):
+        # Run the function in a thread while holding the lock
         if self.lock is None:
             self.lock = asyncio.Lock()
         async with self.lock:
-            return await asyncio.to_thread(self._get, key)
+            return await asyncio.to_thread(func, *args)
 
-    def _get(self, key):
-        # Get data from the file if it exists
-        try:
-            with open(self.filename) as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            data = {}
+    async def set(self, key, value):
+        await self.set_many([(key, value)])
+
+    async def set_many(self, items):
+        items = list(items)
+        await self._run(self._set_many, items)
+        self._notify(str(key) for key, value in items)
+
+    def _set_many(self, items):
+        data, sets = self._load()
+        for key, value in items:
+            # Don't store empty string values
+            key, value = str(key), str(value)
+            if not value:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        self._dump(data, sets)
+
+    async def get(self, key):
+        [value] = await self._run(self._get_many, [key])
+        return value
+
+    async def get_many(self, keys):
+        return await self._run(self._get_many, list(keys))
+
+    def _get_many(self, keys):
+        data, sets = self._load()
         # Keys that don't exist are ""
-        return data.get(str(key), "")
+        return [data.get(str(key), "") for key in keys]
+
+    async def incr(self, key, delta=1):
+        number = await self._run(self._incr, str(key), delta)
+        self._notify([str(key)])
+        return number
+
+    def _incr(self, key, delta):
+        data, sets = self._load()
+        number = int(data.get(key, "0")) + delta
+        data[key] = str(number)
+        self._dump(data, sets)
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        succeeded = await self._run(
+            self._compare_and_set, str(key), str(expected), str(new),
+        )
+        if succeeded:
+            self._notify([str(key)])
+        return succeeded
+
+    def _compare_and_set(self, key, expected, new):
+        data, sets = self._load()
+        if data.get(key, "") != expected:
+            return False
+        # Don't store empty string values
+        if not new:
+            data.pop(key, None)
+        else:
+            data[key] = new
+        self._dump(data, sets)
+        return True
+
+    async def set_add(self, key, *members):
+        members = {str(member) for member in members}
+        await self._run(self._set_update, str(key), members, set())
+        self._notify([str(key)])
+
+    async def set_remove(self, key, *members):
+        members = {str(member) for member in members}
+        await self._run(self._set_update, str(key), set(), members)
+        self._notify([str(key)])
+
+    def _set_update(self, key, added, removed):
+        data, sets = self._load()
+        members = sets.get(key, set())
+        new = (members | added) - removed
+        if new == members:
+            return
+        # Don't store empty sets
+        if not new:
+            sets.pop(key, None)
+        else:
+            sets[key] = new
+        self._dump(data, sets)
+
+    async def set_members(self, key):
+        return await self._run(self._set_members, str(key))
+
+    def _set_members(self, key):
+        data, sets = self._load()
+        return sets.get(key, set())
+
+    async def keys(self, pattern=None):
+        keys = await self._run(self._keys, pattern, False)
+        for key in keys:
+            yield key
+
+    async def set_keys(self, pattern=None):
+        keys = await self._run(self._keys, pattern, True)
+        for key in keys:
+            yield key
+
+    def _keys(self, pattern, of_sets):
+        data, sets = self._load()
+        keys = sets.keys() if of_sets else data.keys()
+        if pattern is None:
+            return list(keys)
+        return [key for key in keys if fnmatch.fnmatchcase(key, pattern)]
+
+class ResidentJsonStore(JsonStore):
+    """This class keeps the JSON encoded file's data in memory
+
+    The file is read once on first use. Each .set call only updates the data
+    in memory and schedules a flush, so reads never touch the disk. All writes
+    made within .flush_delay seconds of each other are written to the file in
+    a single rewrite.
+
+    Pending writes are lost if the process dies before they're flushed. Await
+    .close() (or .flush()) to write them out immediately.
+
+    """
+    DEFAULT_FLUSH_DELAY = 1.0
+    # Longest wait before retrying a failed flush
+    MAX_RETRY_DELAY = 60.0
 
-    async def keys(self):
+    def __init__(self, filename=None, *, flush_delay=None):
+        super().__init__(filename)
+        if flush_delay is None:
+            flush_delay = type(self).DEFAULT_FLUSH_DELAY
+        self.flush_delay = flush_delay
+        self.data = None
+        self.sets = None
+        self.index = None
+        self.dirty = False
+        self._flush_task = None
+
+    async def _ensure_loaded(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        if self.data is None:
+            async with self.lock:
+                # Another task could have loaded it while we were waiting
+                if self.data is None:
+                    data, sets = await asyncio.to_thread(self._load)
+                    self.index = KeyIndex(data)
+                    self.sets = sets
+                    self.data = data
+
+    def _schedule_flush(self):
+        self.dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self.flush_delay
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception:
+                # Try again later instead of losing the changes
+                traceback.print_exc()
+                delay = min(self.MAX_RETRY_DELAY, max(1.0, delay * 2))
+                continue
+            # Writes made while the file was being written don't start
+            # another flush, so this one has to handle them
+            if not self.dirty:
+                return
+            delay = self.flush_delay
+
+    async def flush(self):
+        """Writes any pending changes to the file"""
         if self.lock is None:
             self.lock = asyncio.Lock()
         async with self.lock:
-            keys = await asyncio.to_thread(self._keys)
-        for key in keys:
+            if not self.dirty:
+                return
+            # Copy so that writes can continue while the file is written
+            data = dict(self.data)
+            sets = {key: set(members) for key, members in self.sets.items()}
+            self.dirty = False
+            try:
+                await asyncio.to_thread(self._dump, data, sets)
+            except BaseException:
+                self.dirty = True
+                raise
+
+    async def close(self):
+        # Don't let the scheduled flush race with this one
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+        await self.flush()
+
+    async def set(self, key, value):
+        await self.set_many([(key, value)])
+
+    async def set_many(self, items):
+        await self._ensure_loaded()
+        self._update(items)
+
+    def _update(self, items):
+        changed = []
+        for key, value in items:
+            # Don't store empty string values
+            key, value = str(key), str(value)
+            if not value:
+                if self.data.pop(key, None) is not None:
+                    self.index.discard(key)
+                    changed.append(key)
+            elif self.data.get(key) != value:
+                if key not in self.data:
+                    self.index.add(key)
+                self.data[key] = value
+                changed.append(key)
+        if changed:
+            self._schedule_flush()
+            self._notify(changed)
+
+    async def get(self, key):
+        await self._ensure_loaded()
+        # Keys that don't exist are ""
+        return self.data.get(str(key), "")
+
+    async def get_many(self, keys):
+        await self._ensure_loaded()
+        return [self.data.get(str(key), "") for key in keys]
+
+    # These don't await between reading and writing so they're atomic
+
+    async def incr(self, key, delta=1):
+        await self._ensure_loaded()
+        key = str(key)
+        number = int(self.data.get(key, "0")) + delta
+        self._update([(key, str(number))])
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        await self._ensure_loaded()
+        key = str(key)
+        if self.data.get(key, "") != str(expected):
+            return False
+        self._update([(key, new)])
+        return True
+
+    async def set_add(self, key, *members):
+        await self._ensure_loaded()
+        key = str(key)
+        current = self.sets.setdefault(key, set())
+        size = len(current)
+        current.update(str(member) for member in members)
+        if len(current) != size:
+            self._schedule_flush()
+            self._notify([key])
+        # Don't store empty sets
+        if not current:
+            del self.sets[key]
+
+    async def set_remove(self, key, *members):
+        await self._ensure_loaded()
+        key = str(key)
+        current = self.sets.get(key)
+        if current is None:
+            return
+        size = len(current)
+        current.difference_update(str(member) for member in members)
+        if len(current) != size:
+            self._schedule_flush()
+            self._notify([key])
+        # Don't store empty sets
+        if not current:
+            del self.sets[key]
+
+    async def set_members(self, key):
+        await self._ensure_loaded()
+        # Copy so the caller can't change the stored set
+        return set(self.sets.get(str(key), ()))
+
+    async def keys(self, pattern=None):
+        await self._ensure_loaded()
+        # The scan returns a copy so writes while iterating are fine
+        for key in self.index.scan(pattern):
             yield key
 
-    def _keys(self):
-        # Get data from the file if it exists
-        try:
-            with open(self.filename) as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            data = {}
-        return data.keys()
+    async def set_keys(self, pattern=None):
+        await self._ensure_loaded()
+        for key in list(self.sets):
+            if pattern is None or fnmatch.fnmatchcase(key, pattern):
+                yield key
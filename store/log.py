@@ -0,0 +1,354 @@
+"""Provides an append-only log file backed key-value storage"""
+
+import json
+import asyncio
+import fnmatch
+import os
+
+from . import Store
+from .index import KeyIndex
+
+class BaseLogStore(Store):
+    """This class has the log file handling shared by LogStore and others
+
+    Each change is appended to the log file as a JSON record: [key, value]
+    for values and [key, "+" or "-", members] for set operations. Subclasses
+    keep the data in memory and implement:
+
+    - ._load(), which loads the data (replaying the logs with ._replay) in a
+      thread and opens .file last since that marks the store as loaded
+    - ._apply_record(record), which applies a record to the data
+    - ._should_compact(), which is checked after each write
+    - ._start_compaction(), which is called with the lock held as the log
+      is rotated. It returns what ._write_compaction needs and resets
+      .records.
+    - ._write_compaction(state), which writes the new snapshot in a thread
+      and returns what ._finish_compaction needs
+    - ._finish_compaction(state, result), which is optional
+    - ._unload(), which forgets the data when closed
+
+    Compacting renames the log to .old_log_filename and starts a new one.
+    The old log is removed once the snapshot is written. Only one compaction
+    runs at a time.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.log_filename = filename + ".log"
+        # The log being compacted is renamed to this
+        self.old_log_filename = filename + ".log.old"
+        self.lock = None
+        self.records = 0
+        self.file = None
+        self._compact_task = None
+
+    async def _ensure_loaded(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        if self.file is None:
+            async with self.lock:
+                # Another task could have loaded it while we were waiting
+                if self.file is None:
+                    await asyncio.to_thread(self._load)
+
+    def _replay(self, filename):
+        # Apply each record in the log file and return how many there were
+        records = 0
+        try:
+            file = open(filename, mode="r+")
+        except FileNotFoundError:
+            return 0
+        with file:
+            offset = 0
+            for line in file:
+                try:
+                    if not line.endswith("\n"):
+                        raise ValueError("record is missing its newline")
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record was only partly written - cut it off
+                    file.truncate(offset)
+                    break
+                offset += len(line.encode())
+                self._apply_record(record)
+                records += 1
+        return records
+
+    def _append(self, lines):
+        self.file.write("".join(lines))
+        self.file.flush()
+
+    async def _write(self, records):
+        # Appends the records and applies them. Must hold the lock.
+        lines = [
+            json.dumps(record, separators=",:") + "\n"
+            for record in records
+        ]
+        await asyncio.to_thread(self._append, lines)
+        for record in records:
+            self._apply_record(record)
+        self.records += len(records)
+        self._notify(record[0] for record in records)
+
+    def _rotate(self):
+        # Start a new log, keeping the old one until the snapshot is written
+        self.file.close()
+        os.replace(self.log_filename, self.old_log_filename)
+        self.file = open(self.log_filename, mode="a")
+
+    def _compact_files(self, state):
+        result = self._write_compaction(state)
+        os.unlink(self.old_log_filename)
+        return result
+
+    def _finish_compaction(self, state, result):
+        pass
+
+    async def compact(self):
+        """Writes the data into a new snapshot and empties the log
+
+        If a compaction is already running, this waits for it instead of
+        starting another one (which would replace its old log before its
+        snapshot is written).
+
+        """
+        await self._ensure_loaded()
+        if self._compact_task is None or self._compact_task.done():
+            self._compact_task = asyncio.create_task(self._compact())
+        # Don't cancel the compaction if the caller is cancelled
+        await asyncio.shield(self._compact_task)
+
+    async def _compact(self):
+        async with self.lock:
+            state = self._start_compaction()
+            await asyncio.to_thread(self._rotate)
+        # Writes can continue into the new log while the snapshot is written
+        result = await asyncio.to_thread(self._compact_files, state)
+        self._finish_compaction(state, result)
+
+    def _maybe_compact(self):
+        if self._compact_task is not None and not self._compact_task.done():
+            return
+        if self._should_compact():
+            self._compact_task = asyncio.create_task(self._compact())
+
+    async def close(self):
+        if self._compact_task is not None:
+            await self._compact_task
+            self._compact_task = None
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.file is not None:
+                await asyncio.to_thread(self.file.close)
+                self.file = None
+            self._unload()
+
+class LogStore(BaseLogStore):
+    """This class appends each change to a log file
+
+    All data is kept in memory. On first use, the snapshot file is loaded and
+    the log file is replayed on top of it. Each .set call appends a single
+    record to the log instead of rewriting everything. Set operations append
+    a record of the members added or removed.
+
+    Records that were overwritten by later ones are dead. Once the ratio of
+    dead records passes .compact_ratio, the log is compacted in a background
+    thread: the live data is written as a new snapshot and the log starts over.
+
+    """
+    DEFAULT_FILENAME = "log-store"
+    DEFAULT_COMPACT_RATIO = 0.5
+    DEFAULT_COMPACT_MIN_RECORDS = 1000
+
+    def __init__(
+        self,
+        filename=None,
+        *,
+        compact_ratio=None,
+        compact_min_records=None,
+    ):
+        if filename is None:
+            filename = type(self).DEFAULT_FILENAME
+        if compact_ratio is None:
+            compact_ratio = type(self).DEFAULT_COMPACT_RATIO
+        if compact_min_records is None:
+            compact_min_records = type(self).DEFAULT_COMPACT_MIN_RECORDS
+        super().__init__(filename)
+        self.snapshot_filename = filename + ".json"
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.data = None
+        self.sets = None
+        self.index = None
+        # .records counts the records in the snapshot and logs, both live
+        # and dead
+
+    def _load(self):
+        # Get data from the snapshot if it exists
+        try:
+            with open(self.snapshot_filename) as file:
+                raw = json.load(file)
+        except FileNotFoundError:
+            raw = {}
+        # Split the values from the sets
+        self.data = {}
+        self.sets = {}
+        for key, value in raw.items():
+            if isinstance(value, list):
+                self.sets[key] = set(value)
+            else:
+                self.data[key] = value
+        self.index = KeyIndex(self.data)
+        records = len(raw)
+        # Replay an interrupted compaction's log before the current log
+        interrupted = os.path.exists(self.old_log_filename)
+        for filename in (self.old_log_filename, self.log_filename):
+            records += self._replay(filename)
+        self.records = records
+        # Finish the interrupted compaction so its log can be removed. The
+        # old log goes first as replaying it would undo newer changes, while
+        # replaying the current log on the new snapshot is harmless.
+        if interrupted:
+            self._write_snapshot(self.data, self.sets)
+            os.unlink(self.old_log_filename)
+            with open(self.log_filename, mode="w"):
+                pass
+            self.records = self._live()
+        self.file = open(self.log_filename, mode="a")
+
+    def _unload(self):
+        self.data = None
+        self.sets = None
+        self.index = None
+
+    def _apply_record(self, record):
+        if len(record) == 2:
+            key, value = record
+            # Don't store empty string values
+            if not value:
+                self.index.discard(key)
+                self.data.pop(key, None)
+            else:
+                if key not in self.data:
+                    self.index.add(key)
+                self.data[key] = value
+            return
+        key, operation, members = record
+        current = self.sets.setdefault(key, set())
+        if operation == "+":
+            current.update(members)
+        else:
+            current.difference_update(members)
+        # Don't store empty sets
+        if not current:
+            del self.sets[key]
+
+    def _write_snapshot(self, data, sets):
+        raw = dict(data)
+        for key, members in sets.items():
+            raw[key] = sorted(members)
+        # Write to a temporary file before atomically replacing the snapshot
+        temp_filename = self.snapshot_filename + ".tmp"
+        with open(temp_filename, mode="w") as file:
+            json.dump(raw, file, separators=",:")
+        os.replace(temp_filename, self.snapshot_filename)
+
+    def _live(self):
+        # Number of records a new snapshot would have
+        return len(self.data) + len(self.sets)
+
+    def _should_compact(self):
+        if self.records < self.compact_min_records:
+            return False
+        dead = self.records - self._live()
+        return dead / self.records > self.compact_ratio
+
+    def _start_compaction(self):
+        data = dict(self.data)
+        sets = {key: set(members) for key, members in self.sets.items()}
+        self.records = self._live()
+        return data, sets
+
+    def _write_compaction(self, state):
+        self._write_snapshot(*state)
+
+    async def set(self, key, value):
+        await self.set_many([(key, value)])
+
+    async def set_many(self, items):
+        await self._ensure_loaded()
+        items = [(str(key), str(value)) for key, value in items]
+        if not items:
+            return
+        async with self.lock:
+            await self._write(items)
+        self._maybe_compact()
+
+    async def incr(self, key, delta=1):
+        await self._ensure_loaded()
+        key = str(key)
+        async with self.lock:
+            number = int(self.data.get(key, "0")) + delta
+            await self._write([(key, str(number))])
+        self._maybe_compact()
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        await self._ensure_loaded()
+        key = str(key)
+        async with self.lock:
+            if self.data.get(key, "") != str(expected):
+                return False
+            await self._write([(key, str(new))])
+        self._maybe_compact()
+        return True
+
+    async def get(self, key):
+        await self._ensure_loaded()
+        # Keys that don't exist are ""
+        return self.data.get(str(key), "")
+
+    async def get_many(self, keys):
+        await self._ensure_loaded()
+        return [self.data.get(str(key), "") for key in keys]
+
+    async def keys(self, pattern=None):
+        await self._ensure_loaded()
+        # The scan returns a copy so writes while iterating are fine
+        for key in self.index.scan(pattern):
+            yield key
+
+    async def set_add(self, key, *members):
+        await self._set_update(key, "+", members)
+
+    async def set_remove(self, key, *members):
+        await self._set_update(key, "-", members)
+
+    async def _set_update(self, key, operation, members):
+        await self._ensure_loaded()
+        key = str(key)
+        members = sorted({str(member) for member in members})
+        async with self.lock:
+            current = self.sets.get(key, set())
+            # Skip records that wouldn't change anything
+            adding = operation == "+"
+            members = [
+                member for member in members
+                if (member in current) != adding
+            ]
+            if not members:
+                return
+            await self._write([[key, operation, members]])
+        self._maybe_compact()
+
+    async def set_members(self, key):
+        await self._ensure_loaded()
+        # Copy so the caller can't change the stored set
+        return set(self.sets.get(str(key), ()))
+
+    async def set_keys(self, pattern=None):
+        await self._ensure_loaded()
+        for key in list(self.sets):
+            if pattern is None or fnmatch.fnmatchcase(key, pattern):
+                yield key
@@ -1,6 +1,7 @@
 """Provides a wrapper around two stores being moved"""
 
 import asyncio
+import contextlib
 from . import Store
 
 class MoveStore(Store):
@@ -9,46 +10,220 @@ class MoveStore(Store):
     Before moving, all data will use the first store.
 
     When .move() is first awaited, it will start copying all data from the
-    first store into the second store using the .keys() async iterator.
+    first store into the second store. Keys are copied in sorted order in
+    batches, with up to .concurrency batches in flight at once.
 
     Reading and writing will still work during moving. When getting a key,
-    the first store will be used. When setting a key, both stores
-    will be used. Calls to .move() will block until all data has been moved and
-    return True.
+    the first store will be used. When setting a key, both stores will be
+    used. Keys set during the move are remembered and skipped by the copy so
+    their new values are never overwritten by old ones. If a key is being
+    copied, setting it waits for its batch to finish before writing to the
+    second store. Writes to the same key are done one at a time so they
+    reach the second store in the same order as the first. Calls to .move()
+    will block until all data has been moved and return True.
+
+    Sets are copied after all the values, one key at a time. Set operations
+    during the move are applied to both stores in the same way as .set.
+
+    .watch() only sees changes made through this object.
+
+    After each batch, the last key copied without gaps is saved in the second
+    store under CHECKPOINT_KEY. If the process dies, a new MoveStore between
+    the same stores will skip keys up to the checkpoint. This is only safe if
+    nothing wrote to the first store in between, so the move should be resumed
+    on startup (see extensions/store.py). Delete the checkpoint key from the
+    second store to start over.
+
+    Once the move finishes, DONE_KEY is set in the second store. A new
+    MoveStore between the same stores then skips the copy (which would
+    overwrite newer data with the first store's old data) and uses the
+    second store right away. Moving out of a store deletes its DONE_KEY.
 
     After moving, all data will use the second store. Calls to .move()
     will do nothing and return False.
 
     """
-    def __init__(self, first, second):
+    CHECKPOINT_KEY = "store/move/checkpoint"
+    DONE_KEY = "store/move/done"
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, first, second, *, batch_size=None, concurrency=None):
+        if batch_size is None:
+            batch_size = type(self).DEFAULT_BATCH_SIZE
+        if concurrency is None:
+            concurrency = type(self).DEFAULT_CONCURRENCY
         self.first = first
         self.second = second
+        self.batch_size = batch_size
+        self.concurrency = concurrency
         self.moving = False
         self.moved = False
+        # Number of keys to copy and copied (or skipped) so far
+        self.total = 0
+        self.copied = 0
         self._finished_moving_event = None
+        # Keys set during the move
+        self._written = set()
+        # Keys being copied mapped to an event set when their batch is done
+        self._copying = {}
+        # Keys being written during the move mapped to [lock, users]
+        self._locks = {}
 
-    async def move(self):
+    async def move(self, progress=None):
+        """Moves all data into the second store
+
+        If progress is given, it's called with the number of keys copied and
+        the total number of keys after each batch.
+
+        """
         # After move
         if self.moved:
             return False
         # During move
         if self.moving:
             await self._finished_moving_event.wait()
-            return True
+            return self.moved
         # Before move
         self.moving = True
         self._finished_moving_event = asyncio.Event()
-        async for key in self.first.keys():
-            value = await self.first.get(key)
-            # There's an edge case where a .set is issued before this .get and
-            # finishes before the .set. The key could will be overwritten with
-            # the old value. We simply hope that the use is OK with that.
-            await self.second.set(key, value)
-        self.moved = True
-        self.moving = False
-        self._finished_moving_event.set()
+        try:
+            if await self.second.get(self.DONE_KEY):
+                # Moved before, and the first store's data is now old
+                self.moved = True
+                return False
+            await self._copy(progress)
+        except BaseException:
+            # Writes only go to the first store again so what we know about
+            # the second store will be wrong
+            self._written.clear()
+            raise
+        else:
+            self.moved = True
+        finally:
+            self.moving = False
+            self._finished_moving_event.set()
         return True
 
+    async def _copy(self, progress):
+        # The first store's data is being moved out so it isn't the result
+        # of a finished move anymore
+        await self.first.delete_many([self.DONE_KEY])
+        checkpoint = await self.second.get(self.CHECKPOINT_KEY)
+        keys = sorted([
+            key
+            async for key in self.first.keys()
+            if key > checkpoint
+            and key not in (self.CHECKPOINT_KEY, self.DONE_KEY)
+        ])
+        batches = [
+            keys[i:i+self.batch_size]
+            for i in range(0, len(keys), self.batch_size)
+        ]
+        set_keys = sorted([key async for key in self.first.set_keys()])
+        self.total = len(keys) + len(set_keys)
+        self.copied = 0
+        # Batches finish out of order so only checkpoint up to the first one
+        # that isn't finished
+        finished = [False] * len(batches)
+        next_unfinished = 0
+        checkpoint_lock = asyncio.Lock()
+        indices = iter(range(len(batches)))
+
+        async def worker():
+            nonlocal next_unfinished
+            for i in indices:
+                await self._copy_batch(batches[i])
+                finished[i] = True
+                self.copied += len(batches[i])
+                if progress is not None:
+                    progress(self.copied, self.total)
+                async with checkpoint_lock:
+                    start = next_unfinished
+                    while (
+                        next_unfinished < len(batches)
+                        and finished[next_unfinished]
+                    ):
+                        next_unfinished += 1
+                    if next_unfinished != start:
+                        last_key = batches[next_unfinished - 1][-1]
+                        await self.second.set(self.CHECKPOINT_KEY, last_key)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        set_keys = iter(set_keys)
+
+        async def set_worker():
+            for key in set_keys:
+                await self._copy_set(key)
+                self.copied += 1
+                if progress is not None:
+                    progress(self.copied, self.total)
+
+        await asyncio.gather(*(set_worker() for _ in range(self.concurrency)))
+        await self.second.set_many([
+            (self.CHECKPOINT_KEY, ""),
+            (self.DONE_KEY, "1"),
+        ])
+
+    async def _copy_batch(self, keys):
+        # Skip keys set during the move and mark the rest as being copied.
+        # There's no await in between so a .set can't sneak in.
+        keys = [key for key in keys if key not in self._written]
+        if not keys:
+            return
+        done = asyncio.Event()
+        for key in keys:
+            self._copying[key] = done
+        try:
+            values = await self.first.get_many(keys)
+            await self.second.set_many(zip(keys, values))
+        finally:
+            for key in keys:
+                del self._copying[key]
+            done.set()
+
+    async def _copy_set(self, key):
+        # Sets aren't skipped when written to since .set_add and .set_remove
+        # are applied after the copy anyway
+        done = asyncio.Event()
+        self._copying[key] = done
+        try:
+            members = await self.first.set_members(key)
+            # Remove members left over from an interrupted move
+            extra = await self.second.set_members(key) - members
+            if extra:
+                await self.second.set_remove(key, *extra)
+            if members:
+                await self.second.set_add(key, *members)
+        finally:
+            del self._copying[key]
+            done.set()
+
+    @contextlib.asynccontextmanager
+    async def _lock_keys(self, keys):
+        # Hold the keys' locks (in sorted order so writes can't deadlock)
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                stack.callback(self._forget_lock, key, entry)
+                await stack.enter_async_context(entry[0])
+            yield
+
+    def _forget_lock(self, key, entry):
+        # Called after the lock is released (or failed to be acquired)
+        entry[1] -= 1
+        # Forget the lock once no one is using it
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def _wait_copied(self, keys):
+        # Wait until none of the keys are being copied
+        events = {self._copying[key] for key in keys if key in self._copying}
+        for event in events:
+            await event.wait()
+
     async def set(self, key, value):
         # After move
         if self.moved:
@@ -58,8 +233,113 @@ class MoveStore(Store):
             await self.first.set(key, value)
         # During move
         else:
-            await self.first.set(key, value)
-            await self.second.set(key, value)
+            key = str(key)
+            self._written.add(key)
+            async with self._lock_keys([key]):
+                await self.first.set(key, value)
+                await self._wait_copied([key])
+                await self.second.set(key, value)
+        self._notify([str(key)])
+
+    async def set_many(self, items):
+        items = [(str(key), value) for key, value in items]
+        keys = [key for key, value in items]
+        # After move
+        if self.moved:
+            await self.second.set_many(items)
+        # Before move
+        elif not self.moving:
+            await self.first.set_many(items)
+        # During move
+        else:
+            self._written.update(keys)
+            async with self._lock_keys(keys):
+                await self.first.set_many(items)
+                await self._wait_copied(keys)
+                await self.second.set_many(items)
+        self._notify(keys)
+
+    async def incr(self, key, delta=1):
+        # After move
+        if self.moved:
+            number = await self.second.incr(key, delta)
+        # Before move
+        elif not self.moving:
+            number = await self.first.incr(key, delta)
+        # During move (the first store decides and the second follows). The
+        # key's lock keeps the second store's writes in the same order.
+        else:
+            key = str(key)
+            self._written.add(key)
+            async with self._lock_keys([key]):
+                number = await self.first.incr(key, delta)
+                await self._wait_copied([key])
+                await self.second.set(key, str(number))
+        self._notify([str(key)])
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        # After move
+        if self.moved:
+            succeeded = await self.second.compare_and_set(key, expected, new)
+        # Before move
+        elif not self.moving:
+            succeeded = await self.first.compare_and_set(key, expected, new)
+        # During move (the first store decides and the second follows). The
+        # key's lock keeps the second store's writes in the same order.
+        else:
+            key = str(key)
+            self._written.add(key)
+            async with self._lock_keys([key]):
+                succeeded = await self.first.compare_and_set(
+                    key, expected, new,
+                )
+                if succeeded:
+                    await self._wait_copied([key])
+                    await self.second.set(key, new)
+        if succeeded:
+            self._notify([str(key)])
+        return succeeded
+
+    async def set_add(self, key, *members):
+        # After move
+        if self.moved:
+            await self.second.set_add(key, *members)
+        # Before move
+        elif not self.moving:
+            await self.first.set_add(key, *members)
+        # During move
+        else:
+            key = str(key)
+            async with self._lock_keys([key]):
+                await self.first.set_add(key, *members)
+                await self._wait_copied([key])
+                await self.second.set_add(key, *members)
+        self._notify([str(key)])
+
+    async def set_remove(self, key, *members):
+        # After move
+        if self.moved:
+            await self.second.set_remove(key, *members)
+        # Before move
+        elif not self.moving:
+            await self.first.set_remove(key, *members)
+        # During move
+        else:
+            key = str(key)
+            async with self._lock_keys([key]):
+                await self.first.set_remove(key, *members)
+                await self._wait_copied([key])
+                await self.second.set_remove(key, *members)
+        self._notify([str(key)])
+
+    async def set_members(self, key):
+        # After move
+        if self.moved:
+            return await self.second.set_members(key)
+        # Before or during move
+        else:
+            return await self.first.set_members(key)
 
     async def get(self, key):
         # After move
@@ -69,12 +349,34 @@ class MoveStore(Store):
         else:
             return await self.first.get(key)
 
-    async def keys(self):
+    async def get_many(self, keys):
+        # After move
+        if self.moved:
+            return await self.second.get_many(keys)
+        # Before or during move
+        else:
+            return await self.first.get_many(keys)
+
+    async def keys(self, pattern=None):
         # After move
         if self.moved:
-            async for key in self.second.keys():
+            async for key in self.second.keys(pattern):
                 yield key
         # Before or during move
         else:
-            async for key in self.first.keys():
+            async for key in self.first.keys(pattern):
+                yield key
+
+    async def set_keys(self, pattern=None):
+        # After move
+        if self.moved:
+            async for key in self.second.set_keys(pattern):
                 yield key
+        # Before or during move
+        else:
+            async for key in self.first.set_keys(pattern):
+                yield key
+
+    async def close(self):
+        await self.first.close()
+        await self.second.close()
@@ -1,73 +1,351 @@
-"""Provides a JSON file backed key-value storage"""
+"""Provides a PostgreSQL backed key-value storage"""
 
+import asyncio
+import fnmatch
 import asyncpg
-import os
 
-from . import Store
+from . import Store, pattern_prefix, prefix_end
 
 class PostgresqlStore(Store):
-    """This class uses a JSON encoded file
+    """This class uses a table in a PostgreSQL database
 
-    The file is read on each .get call and rewritten on each .set call.
+    Connections are taken from a pool that is created on first use. The table
+    is created once when the pool is created instead of on each .set call.
+    asyncpg caches prepared statements per connection, so each query is only
+    parsed and planned once per pooled connection.
+
+    Sets are stored in a separate table with a row per member, so adding or
+    removing a member doesn't touch the rest of the set.
+
+    A trigger sends each changed key as a notification on CHANNEL. .watch()
+    listens for them on a dedicated connection (outside of the pool) that is
+    opened on first use, so it sees changes made by every process. If that
+    connection is lost, .watch() iterators raise ConnectionError and the
+    next .watch() call reconnects.
 
     """
+    shared = True
     DEFAULT_ADDRESS = "postgresql://postgres@localhost/"
+    CHANNEL = "store_changes"
+    # These haven't been measured. An idle bot only keeps one connection
+    # open (small Heroku plans allow 20), and the maximum is asyncpg's.
+    DEFAULT_MIN_SIZE = 1
+    DEFAULT_MAX_SIZE = 10
 
-    def __init__(self, address=None):
+    def __init__(self, address=None, *, min_size=None, max_size=None):
         if address is None:
             address = type(self).DEFAULT_ADDRESS
+        if min_size is None:
+            min_size = type(self).DEFAULT_MIN_SIZE
+        if max_size is None:
+            max_size = type(self).DEFAULT_MAX_SIZE
         self.address = address
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.listener = None
+        self.lock = None
 
-    async def set(self, key, value):
-        conn = await asyncpg.connect(self.address)
-        try:
-            async with conn.transaction():
-                # Ensure the table exists
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS store (
-                        key TEXT NOT NULL PRIMARY KEY,
-                        value TEXT NOT NULL
+    async def _get_pool(self):
+        if self.pool is not None:
+            return self.pool
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # Another task could have made it while we were waiting
+            if self.pool is None:
+                pool = await asyncpg.create_pool(
+                    self.address,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                )
+                try:
+                    await self._setup(pool)
+                except BaseException:
+                    await pool.close()
+                    raise
+                self.pool = pool
+        return self.pool
+
+    async def _setup(self, pool):
+        # Ensure the table exists
+        async with pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS store (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            ''')
+            # Lets prefix scans use the index whatever the collation is
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS store_key_pattern_index
+                ON store (key text_pattern_ops);
+            ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS store_sets (
+                    key TEXT NOT NULL,
+                    member TEXT NOT NULL,
+                    PRIMARY KEY (key, member)
+                );
+            ''')
+            # Notify listeners of changed keys. Payloads have to be shorter
+            # than 8000 bytes so longer keys aren't sent.
+            await conn.execute(f'''
+                CREATE OR REPLACE FUNCTION store_notify() RETURNS trigger AS $$
+                DECLARE
+                    changed_key TEXT;
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        changed_key := OLD.key;
+                    ELSE
+                        changed_key := NEW.key;
+                    END IF;
+                    IF octet_length(changed_key) < 8000 THEN
+                        PERFORM pg_notify('{self.CHANNEL}', changed_key);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            ''')
+            for table in ("store", "store_sets"):
+                exists = await conn.fetchval('''
+                    SELECT EXISTS (
+                        SELECT 1 FROM pg_trigger
+                        WHERE tgname = $1
                     );
-                ''')
+                ''', f"{table}_notify_trigger")
+                if not exists:
+                    await conn.execute(f'''
+                        CREATE TRIGGER {table}_notify_trigger
+                        AFTER INSERT OR UPDATE OR DELETE ON {table}
+                        FOR EACH ROW EXECUTE PROCEDURE store_notify();
+                    ''')
+
+    async def _ensure_listening(self):
+        if self.listener is not None:
+            return
+        # Make sure the trigger exists (this takes the lock too)
+        await self._get_pool()
+        async with self.lock:
+            # Another task could have started it while we were waiting
+            if self.listener is None:
+                listener = await asyncpg.connect(self.address)
+                try:
+                    await listener.add_listener(
+                        self.CHANNEL,
+                        self._on_notification,
+                    )
+                except BaseException:
+                    await listener.close()
+                    raise
+                listener.add_termination_listener(self._on_listener_lost)
+                self.listener = listener
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self._notify([payload])
+
+    def _on_listener_lost(self, connection):
+        if connection is not self.listener:
+            return
+        self.listener = None
+        # Changes made until the next .watch() reconnects are missed
+        self._fail_watchers(
+            ConnectionError("lost the connection listening for changes")
+        )
+
+    async def watch(self, prefix="", *, ready=None):
+        await self._ensure_listening()
+        async for key in super().watch(prefix, ready=ready):
+            yield key
+
+    async def close(self):
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            await listener.close()
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    async def set(self, key, value):
+        pool = await self._get_pool()
+        # Don't store empty string values
+        key, value = str(key), str(value)
+        if not value:
+            await pool.execute('''
+                DELETE FROM store
+                WHERE key = $1;
+            ''', key)
+        else:
+            await pool.execute('''
+                INSERT INTO store (key, value)
+                VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE
+                SET value = $2;
+            ''', key, value)
+
+    async def get(self, key):
+        pool = await self._get_pool()
+        value = await pool.fetchval('''
+            SELECT value FROM store
+            WHERE key = $1 LIMIT 1;
+        ''', str(key))
+        # Keys that don't exist are ""
+        return value or ""
+
+    async def get_many(self, keys):
+        keys = [str(key) for key in keys]
+        pool = await self._get_pool()
+        records = await pool.fetch('''
+            SELECT key, value FROM store
+            WHERE key = ANY($1::TEXT[]);
+        ''', keys)
+        values = dict(records)
+        # Keys that don't exist are ""
+        return [values.get(key, "") for key in keys]
+
+    async def set_many(self, items):
+        # Only the last value of each key is used (an upsert can't change the
+        # same row twice)
+        data = {str(key): str(value) for key, value in items}
+        # Don't store empty string values
+        deleted = [key for key, value in data.items() if not value]
+        updated = {key: value for key, value in data.items() if value}
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
             async with conn.transaction():
-                # Don't store empty string values
-                key, value = str(key), str(value)
-                if not value:
+                if deleted:
                     await conn.execute('''
                         DELETE FROM store
-                        WHERE key = $1;
-                    ''', key)
-                else:
+                        WHERE key = ANY($1::TEXT[]);
+                    ''', deleted)
+                if updated:
                     await conn.execute('''
                         INSERT INTO store (key, value)
-                        VALUES ($1, $2)
+                        SELECT * FROM unnest($1::TEXT[], $2::TEXT[])
                         ON CONFLICT (key) DO UPDATE
-                        SET value = $2;
-                    ''', key, value)
-        finally:
-            await conn.close()
+                        SET value = EXCLUDED.value;
+                    ''', list(updated), list(updated.values()))
 
-    async def get(self, key):
-        conn = await asyncpg.connect(self.address)
-        try:
-            value = await conn.fetchval('''
-                SELECT value FROM store
-                WHERE key = $1 LIMIT 1;
-            ''', str(key))
-            # Keys that don't exist are ""
-            return value or ""
-        except asyncpg.UndefinedTableError:
-            return ""
-        finally:
-            await conn.close()
-
-    async def keys(self):
-        conn = await asyncpg.connect(self.address)
-        try:
+    async def incr(self, key, delta=1):
+        pool = await self._get_pool()
+        value = await pool.fetchval('''
+            INSERT INTO store (key, value)
+            VALUES ($1, $2::BIGINT::TEXT)
+            ON CONFLICT (key) DO UPDATE
+            SET value = (store.value::BIGINT + $2::BIGINT)::TEXT
+            RETURNING value;
+        ''', str(key), delta)
+        return int(value)
+
+    async def compare_and_set(self, key, expected, new):
+        key, expected, new = str(key), str(expected), str(new)
+        pool = await self._get_pool()
+        if expected == new:
+            return await self.get(key) == expected
+        # Keys that don't exist are "" so insert it if it doesn't exist
+        if not expected:
+            result = await pool.fetchval('''
+                INSERT INTO store (key, value)
+                VALUES ($1, $2)
+                ON CONFLICT (key) DO NOTHING
+                RETURNING key;
+            ''', key, new)
+        # Don't store empty string values
+        elif not new:
+            result = await pool.fetchval('''
+                DELETE FROM store
+                WHERE key = $1 AND value = $2
+                RETURNING key;
+            ''', key, expected)
+        else:
+            result = await pool.fetchval('''
+                UPDATE store
+                SET value = $3
+                WHERE key = $1 AND value = $2
+                RETURNING key;
+            ''', key, expected, new)
+        return result is not None
+
+    async def set_add(self, key, *members):
+        if not members:
+            return
+        pool = await self._get_pool()
+        await pool.execute('''
+            INSERT INTO store_sets (key, member)
+            SELECT $1, unnest($2::TEXT[])
+            ON CONFLICT (key, member) DO NOTHING;
+        ''', str(key), [str(member) for member in members])
+
+    async def set_remove(self, key, *members):
+        if not members:
+            return
+        pool = await self._get_pool()
+        await pool.execute('''
+            DELETE FROM store_sets
+            WHERE key = $1 AND member = ANY($2::TEXT[]);
+        ''', str(key), [str(member) for member in members])
+
+    async def set_members(self, key):
+        pool = await self._get_pool()
+        records = await pool.fetch('''
+            SELECT member FROM store_sets
+            WHERE key = $1;
+        ''', str(key))
+        return {record[0] for record in records}
+
+    @staticmethod
+    def _like_pattern(pattern):
+        # Returns the LIKE pattern equivalent to the fnmatch pattern or None
+        # if it can't be translated (character classes)
+        if "[" in pattern:
+            return None
+        parts = []
+        for char in pattern:
+            if char in "\\%_":
+                parts.append("\\" + char)
+            elif char == "*":
+                parts.append("%")
+            elif char == "?":
+                parts.append("_")
+            else:
+                parts.append(char)
+        return "".join(parts)
+
+    async def keys(self, pattern=None):
+        async for key in self._keys("SELECT key FROM store", pattern):
+            yield key
+
+    async def set_keys(self, pattern=None):
+        query = "SELECT DISTINCT key FROM store_sets"
+        async for key in self._keys(query, pattern):
+            yield key
+
+    async def _keys(self, query, pattern):
+        # Only scan the range of keys starting with the pattern's prefix. The
+        # ~>=~ and ~<~ operators can use the text_pattern_ops index
+        conditions = []
+        args = []
+        prefix = pattern_prefix(pattern)
+        if prefix:
+            args.append(prefix)
+            conditions.append(f"key ~>=~ ${len(args)}")
+            end = prefix_end(prefix)
+            if end is not None:
+                args.append(end)
+                conditions.append(f"key ~<~ ${len(args)}")
+        like = None if pattern is None else self._like_pattern(pattern)
+        if like is not None:
+            args.append(like)
+            conditions.append(f"key LIKE ${len(args)}")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
             async with conn.transaction():
-                async for record in conn.cursor('''
-                    SELECT key FROM store;
-                '''):
-                    yield record[0]
-        finally:
-            await conn.close()
+                async for record in conn.cursor(query, *args):
+                    key = record[0]
+                    # Filter out what LIKE couldn't
+                    if like is None and pattern is not None:
+                        if not fnmatch.fnmatchcase(key, pattern):
+                            continue
+                    yield key
@@ -0,0 +1,197 @@
+"""Provides a key-value storage spread across several JSON files"""
+
+import asyncio
+import os
+import urllib.parse
+import zlib
+
+from . import Store, pattern_prefix
+from .json import JsonStore
+
+class ShardedJsonStore(Store):
+    """This class spreads keys across several JsonStore files (shards)
+
+    If .shards is a number, each key goes to the shard picked by the CRC32 of
+    the key. If .shards is "namespace", each key goes to the shard for its
+    first path segment (like "help/"), so each cog's data is in its own file.
+
+    Each shard has its own lock, so a write only rewrites its own shard and
+    writes to different shards run in parallel. .keys() goes through one
+    shard at a time, skipping shards that can't have matching keys.
+
+    The files are kept in .directory and are named after the number of
+    shards, so stores with different numbers of shards can share a directory.
+    Use a MoveStore to change the number of shards.
+
+    """
+    DEFAULT_DIRECTORY = "json-store-shards"
+    DEFAULT_SHARDS = 8
+
+    def __init__(self, directory=None, *, shards=None):
+        if directory is None:
+            directory = type(self).DEFAULT_DIRECTORY
+        if shards is None:
+            shards = type(self).DEFAULT_SHARDS
+        if shards != "namespace" and shards < 1:
+            raise ValueError(f"shards must be at least 1: {shards!r}")
+        self.directory = directory
+        self.shards = shards
+        # Shard filenames mapped to their stores
+        self.stores = {}
+        self.lock = None
+        self._started = False
+
+    async def _ensure_started(self):
+        if self._started:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # Another task could have started it while we were waiting
+            if not self._started:
+                names = await asyncio.to_thread(self._start)
+                for name in names:
+                    self._store(name)
+                self._started = True
+
+    def _start(self):
+        # Returns the names of the existing shards
+        os.makedirs(self.directory, exist_ok=True)
+        if self.shards != "namespace":
+            return [self._hash_name(i) for i in range(self.shards)]
+        return [
+            name for name in os.listdir(self.directory)
+            if name.startswith("namespace-") and name.endswith(".json")
+        ]
+
+    def _hash_name(self, i):
+        return f"{i}-of-{self.shards}.json"
+
+    @staticmethod
+    def _namespace_name(namespace):
+        return f"namespace-{urllib.parse.quote(namespace, safe='')}.json"
+
+    def _name(self, key):
+        # Returns the name of the key's shard
+        if self.shards != "namespace":
+            return self._hash_name(zlib.crc32(key.encode()) % self.shards)
+        namespace, slash, rest = key.partition("/")
+        # Keys without a namespace share one shard
+        if not slash:
+            namespace = ""
+        return self._namespace_name(namespace)
+
+    def _store(self, name):
+        store = self.stores.get(name)
+        if store is None:
+            store = JsonStore(os.path.join(self.directory, name))
+            self.stores[name] = store
+        return store
+
+    async def _shard(self, key):
+        await self._ensure_started()
+        return self._store(self._name(str(key)))
+
+    async def _group(self, keys):
+        # Returns the shards mapped to the indices of their keys
+        await self._ensure_started()
+        groups = {}
+        for i, key in enumerate(keys):
+            store = self._store(self._name(key))
+            groups.setdefault(store, []).append(i)
+        return groups
+
+    def _matching(self, pattern):
+        # Returns the shards that could have keys matching the pattern
+        if pattern is None:
+            return list(self.stores.values())
+        prefix = pattern_prefix(pattern)
+        if self.shards != "namespace":
+            # Without wildcards there's only one key that can match
+            if prefix == pattern:
+                return [self._store(self._name(pattern))]
+            return list(self.stores.values())
+        namespace, slash, rest = prefix.partition("/")
+        if slash:
+            return [self._store(self._name(prefix))]
+        # The namespace isn't fully known so check the shards it could be
+        start = self._namespace_name(namespace).removesuffix(".json")
+        names = [self._namespace_name("")] + [
+            name for name in self.stores if name.startswith(start)
+        ]
+        return [self._store(name) for name in dict.fromkeys(names)]
+
+    async def set(self, key, value):
+        store = await self._shard(key)
+        await store.set(str(key), value)
+        self._notify([str(key)])
+
+    async def get(self, key):
+        store = await self._shard(key)
+        return await store.get(str(key))
+
+    async def set_many(self, items):
+        items = [(str(key), value) for key, value in items]
+        groups = await self._group([key for key, value in items])
+        await asyncio.gather(*(
+            store.set_many([items[i] for i in indices])
+            for store, indices in groups.items()
+        ))
+        self._notify(key for key, value in items)
+
+    async def get_many(self, keys):
+        keys = [str(key) for key in keys]
+        groups = await self._group(keys)
+        results = await asyncio.gather(*(
+            store.get_many([keys[i] for i in indices])
+            for store, indices in groups.items()
+        ))
+        values = [""] * len(keys)
+        for indices, group_values in zip(groups.values(), results):
+            for i, value in zip(indices, group_values):
+                values[i] = value
+        return values
+
+    async def incr(self, key, delta=1):
+        store = await self._shard(key)
+        number = await store.incr(str(key), delta)
+        self._notify([str(key)])
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        store = await self._shard(key)
+        succeeded = await store.compare_and_set(str(key), expected, new)
+        if succeeded:
+            self._notify([str(key)])
+        return succeeded
+
+    async def set_add(self, key, *members):
+        store = await self._shard(key)
+        await store.set_add(str(key), *members)
+        self._notify([str(key)])
+
+    async def set_remove(self, key, *members):
+        store = await self._shard(key)
+        await store.set_remove(str(key), *members)
+        self._notify([str(key)])
+
+    async def set_members(self, key):
+        store = await self._shard(key)
+        return await store.set_members(str(key))
+
+    async def keys(self, pattern=None):
+        await self._ensure_started()
+        for store in self._matching(pattern):
+            async for key in store.keys(pattern):
+                yield key
+
+    async def set_keys(self, pattern=None):
+        await self._ensure_started()
+        for store in self._matching(pattern):
+            async for key in store.set_keys(pattern):
+                yield key
+
+    async def close(self):
+        await asyncio.gather(*(
+            store.close() for store in self.stores.values()
+        ))
@@ -0,0 +1,490 @@
+"""Provides a memory-mapped snapshot file backed key-value storage
+
+A snapshot file has a header, a table of fixed size entries, and the
+encoded keys and values:
+
+    header: b"ULSNAP01", number of values, number of sets
+    entries: key offset, key length, value offset, value length
+    data: UTF-8 keys and values (sets are JSON lists of their members)
+
+The value entries come first followed by the set entries, each sorted by
+key. Entries have a fixed size, so a key can be found by binary searching
+the table without reading the rest of the file.
+
+Convert a JSON store file with:
+
+    python -m store.snapshot from-json json-store.json snapshot-store.snap
+    python -m store.snapshot to-json snapshot-store.snap json-store.json
+
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import heapq
+import json
+import mmap
+import os
+import struct
+
+from . import batched, pattern_prefix, prefix_end
+from .index import KeyIndex
+from .log import BaseLogStore
+
+MAGIC = b"ULSNAP01"
+HEADER = struct.Struct("<8sQQ")
+ENTRY = struct.Struct("<QIQI")
+
+class Snapshot:
+    """This class reads a snapshot file without loading it
+
+    The file is memory-mapped when opened, so opening it only reads the
+    header. Lookups and scans only read the pages they need. A missing file
+    is read as an empty snapshot.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = None
+        self.values = 0
+        self.sets = 0
+        try:
+            file = open(filename, mode="rb")
+        except FileNotFoundError:
+            return
+        with file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.values, self.sets = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"not a snapshot file: {filename!r}")
+
+    def __len__(self):
+        return self.values + self.sets
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self.map, HEADER.size + i * ENTRY.size)
+
+    def _key(self, i):
+        key_offset, key_length, value_offset, value_length = self._entry(i)
+        return self.map[key_offset:key_offset+key_length]
+
+    def _item(self, i):
+        key_offset, key_length, value_offset, value_length = self._entry(i)
+        key = self.map[key_offset:key_offset+key_length]
+        value = self.map[value_offset:value_offset+value_length]
+        return key.decode(), value.decode()
+
+    def _bisect(self, lo, hi, key):
+        # Returns the index of the first entry in lo:hi not less than the key
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, lo, hi, key):
+        # Returns the entry's index or None if the key isn't in lo:hi
+        key = key.encode()
+        i = self._bisect(lo, hi, key)
+        if i < hi and self._key(i) == key:
+            return i
+        return None
+
+    def _scan(self, lo, hi, pattern):
+        # Yields the index and key of the entries in lo:hi matching the
+        # pattern in sorted order. UTF-8 sorts the same way as the code points
+        # do.
+        prefix = pattern_prefix(pattern)
+        end = prefix_end(prefix)
+        start = self._bisect(lo, hi, prefix.encode())
+        if end is not None:
+            hi = self._bisect(start, hi, end.encode())
+        for i in range(start, hi):
+            key = self._key(i).decode()
+            if pattern is None or fnmatch.fnmatchcase(key, pattern):
+                yield i, key
+
+    def get(self, key):
+        """Returns the key's value or "" if it doesn't exist"""
+        if self.map is None:
+            return ""
+        i = self._find(0, self.values, key)
+        if i is None:
+            return ""
+        return self._item(i)[1]
+
+    def members(self, key):
+        """Returns the set's members or an empty set if it doesn't exist"""
+        if self.map is None:
+            return set()
+        i = self._find(self.values, self.values + self.sets, key)
+        if i is None:
+            return set()
+        return set(json.loads(self._item(i)[1]))
+
+    def items(self, pattern=None):
+        """Yields each (key, value) matching the pattern in sorted order"""
+        if self.map is not None:
+            for i, key in self._scan(0, self.values, pattern):
+                yield self._item(i)
+
+    def set_items(self, pattern=None):
+        """Yields each (key, members) matching the pattern in sorted order"""
+        if self.map is not None:
+            end = self.values + self.sets
+            for i, key in self._scan(self.values, end, pattern):
+                yield key, set(json.loads(self._item(i)[1]))
+
+    def keys(self, pattern=None):
+        """Yields each key matching the pattern in sorted order"""
+        if self.map is not None:
+            for i, key in self._scan(0, self.values, pattern):
+                yield key
+
+def write(filename, items, set_items):
+    """Writes a snapshot file with the (key, value) and (key, members) pairs
+
+    The file is written to a temporary file before atomically replacing the
+    actual file.
+
+    """
+    values = sorted(
+        (str(key).encode(), str(value).encode())
+        for key, value in items
+    )
+    sets = sorted(
+        (str(key).encode(), json.dumps(sorted(members)).encode())
+        for key, members in set_items
+    )
+    entries = values + sets
+    offset = HEADER.size + len(entries) * ENTRY.size
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, mode="wb") as file:
+        file.write(HEADER.pack(MAGIC, len(values), len(sets)))
+        for key, value in entries:
+            file.write(ENTRY.pack(
+                offset,
+                len(key),
+                offset + len(key),
+                len(value),
+            ))
+            offset += len(key) + len(value)
+        for key, value in entries:
+            file.write(key)
+            file.write(value)
+    os.replace(temp_filename, filename)
+
+def merge(items, changes):
+    """Yields the sorted (key, value) items with the changes applied
+
+    The changes map keys to their new values, where an empty value deletes
+    the key.
+
+    """
+    changed = ((key, 0, value) for key, value in sorted(changes.items()))
+    unchanged = ((key, 1, value) for key, value in items)
+    previous = None
+    # For equal keys the change comes first
+    for key, order, value in heapq.merge(changed, unchanged):
+        if key == previous:
+            continue
+        previous = key
+        if value:
+            yield key, value
+
+def _store_filename(snapshot_filename):
+    # The SnapshotStore filename prefix for the snapshot file
+    if snapshot_filename.endswith(".snap"):
+        return snapshot_filename[:-len(".snap")]
+    return snapshot_filename
+
+def from_json(json_filename, snapshot_filename):
+    """Converts a JsonStore file into a snapshot file
+
+    Raises FileExistsError if the snapshot has non-empty logs, as they
+    would be replayed on top of the new snapshot.
+
+    """
+    from .json import JsonStore
+    filename = _store_filename(snapshot_filename)
+    for log_filename in (filename + ".log", filename + ".log.old"):
+        if os.path.exists(log_filename) and os.path.getsize(log_filename):
+            raise FileExistsError(
+                f"{log_filename} would be replayed over the new snapshot."
+                f" Remove it (and {snapshot_filename}) first."
+            )
+    data, sets = JsonStore(json_filename)._load()
+    write(snapshot_filename, data.items(), sets.items())
+
+def to_json(snapshot_filename, json_filename):
+    """Converts a snapshot file (and its logs) into a JsonStore file"""
+    from .json import JsonStore
+    data, sets = asyncio.run(_read_all(_store_filename(snapshot_filename)))
+    JsonStore(json_filename)._dump(data, sets)
+
+async def _read_all(filename):
+    # Returns the SnapshotStore's values and sets with its logs applied
+    store = SnapshotStore(filename)
+    try:
+        data = {}
+        async for keys in batched(store.keys(), 1000):
+            for key, value in zip(keys, await store.get_many(keys)):
+                if value:
+                    data[key] = value
+        sets = {}
+        async for key in store.set_keys():
+            if members := await store.set_members(key):
+                sets[key] = set(members)
+        return data, sets
+    finally:
+        await store.close()
+
+class SnapshotStore(BaseLogStore):
+    """This class serves a snapshot file with the changes made since
+
+    Opening the store maps the snapshot file and replays the log of changes
+    made since it was written. The log is kept under .max_log_records
+    records, so opening doesn't depend on the number of keys. Each .set call
+    appends a record to the log (in the same format as LogStore) and keeps
+    the change in memory on top of the snapshot.
+
+    Once the log has .max_log_records records, a new snapshot with the
+    changes applied is written in a background thread and the log starts
+    over.
+
+    """
+    DEFAULT_FILENAME = "snapshot-store"
+    DEFAULT_MAX_LOG_RECORDS = 10000
+
+    def __init__(self, filename=None, *, max_log_records=None):
+        if filename is None:
+            filename = type(self).DEFAULT_FILENAME
+        if max_log_records is None:
+            max_log_records = type(self).DEFAULT_MAX_LOG_RECORDS
+        super().__init__(filename)
+        self.snapshot_filename = filename + ".snap"
+        self.max_log_records = max_log_records
+        self.snapshot = None
+        # Keys changed since the snapshot mapped to their values ("" if
+        # deleted) and an index of them for scans
+        self.changes = None
+        self.index = None
+        # Sets changed since the snapshot mapped to all of their members
+        self.sets = None
+        # .records counts the records in the logs
+
+    def _load(self):
+        # The log is opened last since it marks the store as loaded
+        self.snapshot = Snapshot(self.snapshot_filename)
+        self.changes = {}
+        self.index = KeyIndex()
+        self.sets = {}
+        # An interrupted compaction's log could be in the snapshot or not.
+        # Replaying it again gives the same result either way.
+        interrupted = os.path.exists(self.old_log_filename)
+        records = 0
+        for filename in (self.old_log_filename, self.log_filename):
+            records += self._replay(filename)
+        self.records = records
+        # Put both logs' records into one log so the old one can be removed
+        if interrupted:
+            temp_filename = self.log_filename + ".tmp"
+            with open(temp_filename, mode="wb") as file:
+                for filename in (self.old_log_filename, self.log_filename):
+                    try:
+                        with open(filename, mode="rb") as log:
+                            file.write(log.read())
+                    except FileNotFoundError:
+                        pass
+            os.replace(temp_filename, self.log_filename)
+            os.unlink(self.old_log_filename)
+        self.file = open(self.log_filename, mode="a")
+
+    def _unload(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = None
+        self.changes = None
+        self.index = None
+        self.sets = None
+
+    def _apply_record(self, record):
+        if len(record) == 2:
+            key, value = record
+            if key not in self.changes:
+                self.index.add(key)
+            self.changes[key] = value
+            return
+        key, operation, members = record
+        current = self._members(key)
+        if operation == "+":
+            current.update(members)
+        else:
+            current.difference_update(members)
+
+    def _members(self, key):
+        # Returns the set's members, copying them from the snapshot the
+        # first time the set is changed
+        members = self.sets.get(key)
+        if members is None:
+            members = self.snapshot.members(key)
+            self.sets[key] = members
+        return members
+
+    def _should_compact(self):
+        return self.records >= self.max_log_records
+
+    def _start_compaction(self):
+        snapshot = self.snapshot
+        changes = dict(self.changes)
+        sets = {key: set(members) for key, members in self.sets.items()}
+        self.records = 0
+        return snapshot, changes, sets
+
+    def _write_compaction(self, state):
+        snapshot, changes, sets = state
+        write(
+            self.snapshot_filename,
+            merge(snapshot.items(), changes),
+            merge(snapshot.set_items(), sets),
+        )
+        return Snapshot(self.snapshot_filename)
+
+    def _finish_compaction(self, state, new_snapshot):
+        # Only keep the changes made since. The old snapshot isn't closed
+        # since scans could still be using it.
+        snapshot, changes, sets = state
+        self.snapshot = new_snapshot
+        self.changes = {
+            key: value for key, value in self.changes.items()
+            if changes.get(key) != value
+        }
+        self.index = KeyIndex(self.changes)
+        self.sets = {
+            key: members for key, members in self.sets.items()
+            if sets.get(key) != members
+        }
+
+    def _get(self, key):
+        value = self.changes.get(key)
+        if value is None:
+            return self.snapshot.get(key)
+        return value
+
+    async def set(self, key, value):
+        await self.set_many([(key, value)])
+
+    async def set_many(self, items):
+        await self._ensure_loaded()
+        items = [[str(key), str(value)] for key, value in items]
+        if not items:
+            return
+        async with self.lock:
+            await self._write(items)
+        self._maybe_compact()
+
+    async def get(self, key):
+        await self._ensure_loaded()
+        return self._get(str(key))
+
+    async def get_many(self, keys):
+        await self._ensure_loaded()
+        return [self._get(str(key)) for key in keys]
+
+    async def incr(self, key, delta=1):
+        await self._ensure_loaded()
+        key = str(key)
+        async with self.lock:
+            number = int(self._get(key) or "0") + delta
+            await self._write([[key, str(number)]])
+        self._maybe_compact()
+        return number
+
+    async def compare_and_set(self, key, expected, new):
+        await self._ensure_loaded()
+        key = str(key)
+        async with self.lock:
+            if self._get(key) != str(expected):
+                return False
+            await self._write([[key, str(new)]])
+        self._maybe_compact()
+        return True
+
+    async def set_add(self, key, *members):
+        await self._set_update(key, "+", members)
+
+    async def set_remove(self, key, *members):
+        await self._set_update(key, "-", members)
+
+    async def _set_update(self, key, operation, members):
+        await self._ensure_loaded()
+        key = str(key)
+        members = sorted({str(member) for member in members})
+        async with self.lock:
+            current = self._members(key)
+            # Skip records that wouldn't change anything
+            adding = operation == "+"
+            members = [
+                member for member in members
+                if (member in current) != adding
+            ]
+            if not members:
+                return
+            await self._write([[key, operation, members]])
+        self._maybe_compact()
+
+    async def set_members(self, key):
+        await self._ensure_loaded()
+        # Copy so the caller can't change the stored set
+        return set(self._members(str(key)))
+
+    async def keys(self, pattern=None):
+        await self._ensure_loaded()
+        changes = self.changes
+        changed = ((key, 0) for key in self.index.scan(pattern))
+        unchanged = ((key, 1) for key in self.snapshot.keys(pattern))
+        previous = None
+        # For equal keys the change comes first
+        for key, order in heapq.merge(changed, unchanged):
+            if key == previous:
+                continue
+            previous = key
+            # Deleted keys are ""
+            if order == 1 or changes.get(key):
+                yield key
+
+    async def set_keys(self, pattern=None):
+        await self._ensure_loaded()
+        sets = self.sets
+        for key, members in self.snapshot.set_items(pattern):
+            if key not in sets:
+                yield key
+        for key, members in list(sets.items()):
+            if members and (
+                pattern is None or fnmatch.fnmatchcase(key, pattern)
+            ):
+                yield key
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m store.snapshot")
+    parser.add_argument("action", choices=["from-json", "to-json"])
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    args = parser.parse_args()
+    if args.action == "from-json":
+        from_json(args.source, args.destination)
+    else:
+        to_json(args.source, args.destination)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""Provides an SQLite database backed key-value storage"""
+
+import asyncio
+import fnmatch
+import queue
+import sqlite3
+import threading
+
+from . import Store, pattern_prefix, prefix_end
+
+class SqliteStore(Store):
+    """This class uses a table in an SQLite database in WAL mode
+
+    All database calls run on a dedicated thread that owns the connection.
+    Calls are queued and run in order. Writes are committed together once the
+    queue is empty (or after .max_batch writes), so a burst of writes costs
+    a single commit. A write's future is only resolved after its commit.
+    Each write runs in its own savepoint, so a write that fails is rolled
+    back without undoing the others in its batch.
+
+    The sqlite3 module caches prepared statements on the connection.
+
+    Sets are stored in a separate table with a row per member.
+
+    """
+    shared = True
+    DEFAULT_FILENAME = "sqlite-store.db"
+    DEFAULT_MAX_BATCH = 1000
+
+    def __init__(self, filename=None, *, max_batch=None):
+        if filename is None:
+            filename = type(self).DEFAULT_FILENAME
+        if max_batch is None:
+            max_batch = type(self).DEFAULT_MAX_BATCH
+        self.filename = filename
+        self.max_batch = max_batch
+        self.thread = None
+        self.queue = None
+
+    def _ensure_started(self):
+        if self.thread is None:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(
+                target=self._run,
+                args=(self.queue,),
+                name=f"SqliteStore({self.filename!r})",
+                daemon=True,
+            )
+            self.thread.start()
+
+    async def _call(self, func, *args, write=False):
+        # Run the function on the database thread and wait for its result
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((loop, future, func, args, write))
+        return await future
+
+    @staticmethod
+    def _resolve(loop, future, result=None, error=None):
+        def callback():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        try:
+            loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            # The event loop was closed so no one is waiting anymore
+            pass
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Wait instead of failing when another process holds the lock
+            conn.execute("PRAGMA busy_timeout=5000")
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS store (
+                        key TEXT NOT NULL PRIMARY KEY,
+                        value TEXT NOT NULL
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS store_sets (
+                        key TEXT NOT NULL,
+                        member TEXT NOT NULL,
+                        PRIMARY KEY (key, member)
+                    ) WITHOUT ROWID
+                ''')
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _run(self, jobs):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            # Fail every call since there's no database to run them on
+            while (job := jobs.get()) is not None:
+                loop, future, *_ = job
+                self._resolve(loop, future, error=e)
+            return
+        try:
+            # Writes waiting to be committed
+            uncommitted = []
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                loop, future, func, args, write = job
+                try:
+                    if write:
+                        result = self._run_write(conn, func, args)
+                    else:
+                        result = func(conn, *args)
+                except Exception as e:
+                    self._resolve(loop, future, error=e)
+                else:
+                    if write:
+                        uncommitted.append((loop, future, result))
+                    else:
+                        self._resolve(loop, future, result)
+                if uncommitted and (
+                    jobs.empty() or len(uncommitted) >= self.max_batch
+                ):
+                    self._commit(conn, uncommitted)
+                    uncommitted = []
+            if uncommitted:
+                self._commit(conn, uncommitted)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _run_write(conn, func, args):
+        # Releasing the outermost savepoint would commit, so start the
+        # batch's transaction first
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("SAVEPOINT write")
+        try:
+            result = func(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK TO write")
+            conn.execute("RELEASE write")
+            raise
+        conn.execute("RELEASE write")
+        return result
+
+    def _commit(self, conn, uncommitted):
+        try:
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            for loop, future, result in uncommitted:
+                self._resolve(loop, future, error=e)
+        else:
+            for loop, future, result in uncommitted:
+                self._resolve(loop, future, result)
+
+    async def close(self):
+        if self.thread is not None:
+            thread, self.thread = self.thread, None
+            self.queue.put(None)
+            await asyncio.to_thread(thread.join)
+
+    @staticmethod
+    def _set_many(conn, items):
+        # Don't store empty string values
+        deleted = [(key,) for key, value in items if not value]
+        updated = [(key, value) for key, value in items if value]
+        if deleted:
+            conn.executemany('''
+                DELETE FROM store
+                WHERE key = ?
+            ''', deleted)
+        if updated:
+            conn.executemany('''
+                INSERT INTO store (key, value)
+                VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE
+                SET value = excluded.value
+            ''', updated)
+
+    async def set(self, key, value):
+        await self.set_many([(key, value)])
+
+    async def set_many(self, items):
+        items = [(str(key), str(value)) for key, value in items]
+        await self._call(self._set_many, items, write=True)
+        self._notify(key for key, value in items)
+
+    @staticmethod
+    def _get_many(conn, keys):
+        values = []
+        for key in keys:
+            row = conn.execute('''
+                SELECT value FROM store
+                WHERE key = ?
+            ''', (key,)).fetchone()
+            # Keys that don't exist are ""
+            values.append(row[0] if row is not None else "")
+        return values
+
+    async def get(self, key):
+        [value] = await self.get_many([key])
+        return value
+
+    async def get_many(self, keys):
+        keys = [str(key) for key in keys]
+        return await self._call(self._get_many, keys)
+
+    # The write takes SQLite's write lock before the read so these are atomic
+    # even with other processes
+
+    @staticmethod
+    def _incr(conn, key, delta):
+        # Take the write lock by making sure the key exists. If the value
+        # isn't a number, int raises ValueError and the savepoint is rolled
+        # back.
+        conn.execute('''
+            INSERT INTO store (key, value)
+            VALUES (?, '0')
+            ON CONFLICT (key) DO NOTHING
+        ''', (key,))
+        row = conn.execute('''
+            SELECT value FROM store
+            WHERE key = ?
+        ''', (key,)).fetchone()
+        number = int(row[0]) + delta
+        conn.execute('''
+            UPDATE store
+            SET value = ?
+            WHERE key = ?
+        ''', (str(number), key))
+        return number
+
+    async def incr(self, key, delta=1):
+        number = await self._call(self._incr, str(key), delta, write=True)
+        self._notify([str(key)])
+        return number
+
+    @staticmethod
+    def _compare_and_set(conn, key, expected, new):
+        if expected == new:
+            row = conn.execute('''
+                SELECT value FROM store
+                WHERE key = ?
+            ''', (key,)).fetchone()
+            return (row[0] if row is not None else "") == expected
+        # Keys that don't exist are "" so insert it if it doesn't exist
+        if not expected:
+            cursor = conn.execute('''
+                INSERT INTO store (key, value)
+                VALUES (?, ?)
+                ON CONFLICT (key) DO NOTHING
+            ''', (key, new))
+        # Don't store empty string values
+        elif not new:
+            cursor = conn.execute('''
+                DELETE FROM store
+                WHERE key = ? AND value = ?
+            ''', (key, expected))
+        else:
+            cursor = conn.execute('''
+                UPDATE store
+                SET value = ?
+                WHERE key = ? AND value = ?
+            ''', (new, key, expected))
+        return cursor.rowcount == 1
+
+    async def compare_and_set(self, key, expected, new):
+        succeeded = await self._call(
+            self._compare_and_set, str(key), str(expected), str(new),
+            write=True,
+        )
+        if succeeded:
+            self._notify([str(key)])
+        return succeeded
+
+    @staticmethod
+    def _set_add(conn, key, members):
+        conn.executemany('''
+            INSERT INTO store_sets (key, member)
+            VALUES (?, ?)
+            ON CONFLICT (key, member) DO NOTHING
+        ''', [(key, member) for member in members])
+
+    async def set_add(self, key, *members):
+        members = [str(member) for member in members]
+        await self._call(self._set_add, str(key), members, write=True)
+        self._notify([str(key)])
+
+    @staticmethod
+    def _set_remove(conn, key, members):
+        conn.executemany('''
+            DELETE FROM store_sets
+            WHERE key = ? AND member = ?
+        ''', [(key, member) for member in members])
+
+    async def set_remove(self, key, *members):
+        members = [str(member) for member in members]
+        await self._call(self._set_remove, str(key), members, write=True)
+        self._notify([str(key)])
+
+    @staticmethod
+    def _set_members(conn, key):
+        rows = conn.execute('''
+            SELECT member FROM store_sets
+            WHERE key = ?
+        ''', (key,))
+        return {row[0] for row in rows}
+
+    async def set_members(self, key):
+        return await self._call(self._set_members, str(key))
+
+    @staticmethod
+    def _keys(conn, pattern, table="store"):
+        # Only scan the range of keys starting with the pattern's prefix using
+        # the primary key's index
+        prefix = pattern_prefix(pattern)
+        end = prefix_end(prefix)
+        if end is not None:
+            rows = conn.execute(f'''
+                SELECT DISTINCT key FROM {table}
+                WHERE key >= ? AND key < ?
+            ''', (prefix, end))
+        else:
+            rows = conn.execute(f'''
+                SELECT DISTINCT key FROM {table}
+                WHERE key >= ?
+            ''', (prefix,))
+        keys = [row[0] for row in rows]
+        if pattern is not None:
+            keys = [key for key in keys if fnmatch.fnmatchcase(key, pattern)]
+        return keys
+
+    async def keys(self, pattern=None):
+        keys = await self._call(self._keys, pattern)
+        for key in keys:
+            yield key
+
+    async def set_keys(self, pattern=None):
+        keys = await self._call(self._keys, pattern, "store_sets")
+        for key in keys:
+            yield key
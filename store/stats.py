@@ -0,0 +1,263 @@
+"""Provides a wrapper that records statistics about another store's use"""
+
+import time
+
+from . import Store, pattern_prefix
+
+class Histogram:
+    """This class counts latencies in logarithmic buckets
+
+    Each power of two (in nanoseconds) is split into 4 buckets, so recording
+    is a few integer operations and percentiles are within 25%.
+
+    """
+    NUM_BUCKETS = 256
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.errors = 0
+        self.total_ns = 0
+
+    @staticmethod
+    def _bucket(ns):
+        length = ns.bit_length()
+        if length <= 2:
+            return ns
+        return (length - 2) * 4 + ((ns >> (length - 3)) & 3)
+
+    @staticmethod
+    def _bucket_end(bucket):
+        # Returns the smallest latency larger than everything in the bucket
+        if bucket < 4:
+            return bucket + 1
+        length = bucket // 4 + 2
+        return (5 + bucket % 4) << (length - 3)
+
+    def record(self, ns, error=False):
+        self.buckets[min(self._bucket(ns), self.NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += ns
+        if error:
+            self.errors += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.errors += other.errors
+        self.total_ns += other.total_ns
+
+    def percentile(self, fraction):
+        """Returns the latency in seconds below which fraction of them are"""
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return self._bucket_end(bucket) / 1e9
+        return self._bucket_end(self.NUM_BUCKETS - 1) / 1e9
+
+class StoreStats:
+    """This class keeps a histogram per operation and key namespace
+
+    A key's namespace is its first path segment, like "help/" for the key
+    "help/owner/1234".
+
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.since = time.time()
+
+    def reset(self):
+        self.histograms = {}
+        self.since = time.time()
+
+    def record(self, operation, namespace, ns, error=False):
+        histogram = self.histograms.get((operation, namespace))
+        if histogram is None:
+            histogram = self.histograms[operation, namespace] = Histogram()
+        histogram.record(ns, error)
+
+    def by_operation(self):
+        """Returns a dict of operation to histogram over all namespaces"""
+        totals = {}
+        for (operation, namespace), histogram in self.histograms.items():
+            if operation not in totals:
+                totals[operation] = Histogram()
+            totals[operation].merge(histogram)
+        return totals
+
+def namespace(key):
+    """Returns the key's first path segment (or "*" if it has none)"""
+    first, slash, rest = key.partition("/")
+    if not slash:
+        return "*"
+    return first + "/"
+
+def namespace_of_keys(keys):
+    namespaces = {namespace(key) for key in keys}
+    if len(namespaces) == 1:
+        return namespaces.pop()
+    return "*"
+
+class InstrumentedStore(Store):
+    """This class wraps another store and records each call in a StoreStats
+
+    The stats object can be shared so that it outlives this wrapper.
+
+    """
+    def __init__(self, store, stats=None):
+        if stats is None:
+            stats = StoreStats()
+        self.store = store
+        self.stats = stats
+
+    async def get(self, key):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            value = await self.store.get(key)
+            error = False
+            return value
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("get", namespace(key), elapsed, error)
+
+    async def set(self, key, value):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            await self.store.set(key, value)
+            error = False
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("set", namespace(key), elapsed, error)
+
+    async def get_many(self, keys):
+        keys = [str(key) for key in keys]
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            values = await self.store.get_many(keys)
+            error = False
+            return values
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            name = namespace_of_keys(keys)
+            self.stats.record("get_many", name, elapsed, error)
+
+    async def set_many(self, items):
+        items = [(str(key), value) for key, value in items]
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            await self.store.set_many(items)
+            error = False
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            name = namespace_of_keys(key for key, value in items)
+            self.stats.record("set_many", name, elapsed, error)
+
+    async def incr(self, key, delta=1):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            number = await self.store.incr(key, delta)
+            error = False
+            return number
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("incr", namespace(key), elapsed, error)
+
+    async def compare_and_set(self, key, expected, new):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            succeeded = await self.store.compare_and_set(key, expected, new)
+            error = False
+            return succeeded
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("cas", namespace(key), elapsed, error)
+
+    async def set_add(self, key, *members):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            await self.store.set_add(key, *members)
+            error = False
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("set_add", namespace(key), elapsed, error)
+
+    async def set_remove(self, key, *members):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            await self.store.set_remove(key, *members)
+            error = False
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("set_remove", namespace(key), elapsed, error)
+
+    async def set_members(self, key):
+        key = str(key)
+        start = time.perf_counter_ns()
+        error = True
+        try:
+            members = await self.store.set_members(key)
+            error = False
+            return members
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.stats.record("set_members", namespace(key), elapsed, error)
+
+    async def keys(self, pattern=None):
+        async for key in self._keys("keys", self.store.keys, pattern):
+            yield key
+
+    async def set_keys(self, pattern=None):
+        async for key in self._keys("set_keys", self.store.set_keys, pattern):
+            yield key
+
+    async def _keys(self, operation, keys, pattern):
+        # Only count the time spent in the wrapped store, not by the caller
+        name = namespace(pattern_prefix(pattern))
+        iterator = keys(pattern).__aiter__()
+        elapsed = 0
+        error = True
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                try:
+                    key = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter_ns() - start
+                yield key
+            error = False
+        except GeneratorExit:
+            # The caller stopped early which isn't an error
+            error = False
+            raise
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            self.stats.record(operation, name, elapsed, error)
+
+    async def watch(self, prefix="", *, ready=None):
+        async for key in self.store.watch(prefix, ready=ready):
+            yield key
+
+    async def close(self):
+        await self.store.close()
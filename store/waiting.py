@@ -0,0 +1,82 @@
+"""Provides a wrapper that waits for something before using another store"""
+
+import asyncio
+
+from . import Store
+
+class WaitingStore(Store):
+    """This class waits for an awaitable before using the store it wraps
+
+    This is used when the store extension is reloaded, so the new store
+    doesn't read files (or rows) the old one hasn't finished writing. The
+    awaitable's result (or exception) is ignored.
+
+    """
+
+    def __init__(self, store, ready):
+        self.store = store
+        self.ready = asyncio.ensure_future(ready)
+
+    async def _wait(self):
+        if not self.ready.done():
+            # Don't cancel it if the caller is cancelled
+            await asyncio.wait([self.ready])
+
+    async def set(self, key, value):
+        await self._wait()
+        await self.store.set(key, value)
+
+    async def get(self, key):
+        await self._wait()
+        return await self.store.get(key)
+
+    async def keys(self, pattern=None):
+        await self._wait()
+        async for key in self.store.keys(pattern):
+            yield key
+
+    async def close(self):
+        await self._wait()
+        await self.store.close()
+
+    async def get_many(self, keys):
+        await self._wait()
+        return await self.store.get_many(keys)
+
+    async def set_many(self, items):
+        await self._wait()
+        await self.store.set_many(items)
+
+    async def delete_many(self, keys):
+        await self._wait()
+        await self.store.delete_many(keys)
+
+    async def incr(self, key, delta=1):
+        await self._wait()
+        return await self.store.incr(key, delta)
+
+    async def compare_and_set(self, key, expected, new):
+        await self._wait()
+        return await self.store.compare_and_set(key, expected, new)
+
+    async def set_add(self, key, *members):
+        await self._wait()
+        await self.store.set_add(key, *members)
+
+    async def set_remove(self, key, *members):
+        await self._wait()
+        await self.store.set_remove(key, *members)
+
+    async def set_members(self, key):
+        await self._wait()
+        return await self.store.set_members(key)
+
+    async def set_keys(self, pattern=None):
+        await self._wait()
+        async for key in self.store.set_keys(pattern):
+            yield key
+
+    async def watch(self, prefix="", *, ready=None):
+        await self._wait()
+        async for key in self.store.watch(prefix, ready=ready):
+            yield key
@@ -3,6 +3,10 @@
 For more info on why we have both a run and a _run function, see
 https://github.com/GeeTransit/joshgone/blob/main/joshgone.py and its comments.
 
+If ULHACKS_WORKERS is set, the bot runs in cluster mode: the shards are split
+between that many worker processes, which are restarted if they crash. See
+run_cluster and assign_shards for more info.
+
 """
 import os
 import discord
@@ -12,18 +16,46 @@ command_prefix = commands.when_mentioned_or("$")
 
 intents = discord.Intents.all()
 
-def _run(token, **bot_kwargs):
-    bot = commands.Bot(**bot_kwargs)
+# Loaded in this order by every bot (and every worker in cluster mode)
+EXTENSIONS = [
+    "cogs.store",
+    "cogs.info",
+    "cogs.admin",
+    "cogs.message",
+    "cogs.welcome",
+    "cogs.help",
+    "cogs.moderators",
+    "extensions.store",
+]
+
+class ClosesStoreMixin:
+    async def close(self):
+        # Let cogs finish pending work (like message edits) while connected
+        for cog in tuple(self.cogs.values()):
+            flush = getattr(cog, "flush", None)
+            if flush is not None:
+                await flush()
+        await super().close()
+        # Make sure the store's pending writes are flushed. Unloading the
+        # store extension starts closing it in the background.
+        store = getattr(self, "store", None)
+        if store is not None:
+            await store.close()
+        closing = getattr(self, "store_closing", None)
+        if closing is not None:
+            await closing
+
+class Bot(ClosesStoreMixin, commands.Bot):
+    pass
+
+class ShardedBot(ClosesStoreMixin, commands.AutoShardedBot):
+    pass
 
-    bot.load_extension("cogs.store")
-    bot.load_extension("cogs.info")
-    bot.load_extension("cogs.admin")
-    bot.load_extension("cogs.message")
-    bot.load_extension("cogs.welcome")
-    bot.load_extension("cogs.help")
-    bot.load_extension("cogs.moderators")
+def _run(token, *, bot_class=Bot, **bot_kwargs):
+    bot = bot_class(**bot_kwargs)
 
-    bot.load_extension("extensions.store")
+    for name in EXTENSIONS:
+        bot.load_extension(name)
 
     close = bot.loop.close
     bot.loop.close = lambda: None
@@ -43,10 +75,159 @@ def run(token, **bot_kwargs):
     finally:
         loop.close()
 
+# The ULHacks server (the message cog looks up members and channels there)
+HOME_GUILD_ID = 871391148239880252
+
+# Discord only allows one shard to identify every 5 seconds
+IDENTIFY_INTERVAL = 5
+# Crashed workers are restarted after a delay that doubles up to this
+MAX_RESTART_DELAY = 60
+
+def _run_worker(token, shard_ids, shard_count, delay):
+    """Runs a worker process's shards (used by run_cluster)"""
+    import time
+    time.sleep(delay)
+    run(
+        token,
+        bot_class=ShardedBot,
+        command_prefix=command_prefix,
+        intents=intents,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+    )
+
+def assign_shards(workers, shard_count, guild_id=HOME_GUILD_ID):
+    """Returns a list of shard IDs for each worker
+
+    Worker i runs shards i, i + workers, i + 2*workers, and so on, except
+    that worker 0 also runs the guild's shard. Direct messages only reach
+    shard 0, and requests sent there are checked against and forwarded to
+    the guild, so both shards have to be in the same process.
+
+    Raises ValueError if a worker would be left without shards.
+
+    """
+    if not 0 < workers <= shard_count:
+        raise ValueError(
+            f"need between 1 and {shard_count} workers, not {workers}"
+        )
+    shard_ids = [list(range(i, shard_count, workers)) for i in range(workers)]
+    # Discord puts guilds on shards using this formula
+    guild_shard = (guild_id >> 22) % shard_count
+    worker = guild_shard % workers
+    if worker != 0:
+        if len(shard_ids[0]) == 1:
+            raise ValueError(
+                f"shard {guild_shard} (which has the server) needs to be with"
+                f" shard 0, leaving worker {worker} without shards. Use more"
+                f" than {shard_count} shards."
+            )
+        # Swap it with one of worker 0's other shards
+        other = shard_ids[0].pop()
+        shard_ids[worker].remove(guild_shard)
+        shard_ids[worker].append(other)
+        shard_ids[worker].sort()
+        shard_ids[0].append(guild_shard)
+        shard_ids[0].sort()
+    return shard_ids
+
+def default_shard_count(workers):
+    """Returns the fewest shards that can be split between the workers"""
+    shard_count = workers
+    while True:
+        try:
+            assign_shards(workers, shard_count)
+        except ValueError:
+            shard_count += 1
+        else:
+            return shard_count
+
+def run_cluster(token, *, workers, shard_count):
+    """Runs the ULHacks Bot's shards split between worker processes
+
+    The shards are split using assign_shards. Workers are started one after
+    the other so their shards don't identify at the same time. A worker that crashes is restarted after a delay, which is
+    reset once it has run for MAX_RESTART_DELAY seconds. A worker that exits
+    cleanly (like after $shutdown) stops the whole cluster.
+
+    All workers use the same store, so the store has to be safe to use from
+    several processes (see extensions.store.check_shared).
+
+    """
+    import multiprocessing
+    import signal
+    import sys
+    import time
+    import extensions.store
+    shard_ids = assign_shards(workers, shard_count)
+    extensions.store.check_shared()
+
+    # Spawn so workers don't inherit this process's state
+    context = multiprocessing.get_context("spawn")
+    processes = [None] * workers
+    started = [0.0] * workers
+    restart_delays = [0] * workers
+
+    def start(i, delay):
+        process = context.Process(
+            target=_run_worker,
+            args=(token, shard_ids[i], shard_count, delay),
+            name=f"ulhacks-bot-worker-{i}",
+        )
+        process.start()
+        processes[i] = process
+        started[i] = time.monotonic() + delay
+        print(f"Started worker {i} with shards {shard_ids[i]}")
+
+    # Stop the workers when stopped by Heroku
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        delay = 0
+        for i in range(workers):
+            start(i, delay)
+            delay += IDENTIFY_INTERVAL * len(shard_ids[i])
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                if process.exitcode == 0:
+                    print(f"Worker {i} exited, stopping the cluster")
+                    return
+                if time.monotonic() - started[i] >= MAX_RESTART_DELAY:
+                    restart_delays[i] = 0
+                restart_delays[i] = min(
+                    MAX_RESTART_DELAY,
+                    max(1, restart_delays[i] * 2),
+                )
+                print(
+                    f"Worker {i} exited with code {process.exitcode},"
+                    f" restarting in {restart_delays[i]}s"
+                )
+                start(i, restart_delays[i])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers close their bots (and stores) on SIGTERM
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                process.join()
+
 def main():
     """Entry point to run the ULHacks bot"""
+    token = os.environ["ULHACKS_BOT_TOKEN"]
+    workers = int(os.environ.get("ULHACKS_WORKERS", "0"))
+    if workers > 0:
+        shard_count = os.environ.get("ULHACKS_SHARD_COUNT", None)
+        if shard_count is None:
+            shard_count = default_shard_count(workers)
+        run_cluster(token, workers=workers, shard_count=int(shard_count))
+        return
     run(
-        os.environ["ULHACKS_BOT_TOKEN"],
+        token,
         command_prefix=command_prefix,
         intents=intents,
     )